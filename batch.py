@@ -0,0 +1,284 @@
+"""
+Converts many `.obj` files in one go on a shared process pool.
+
+Every input is voxelized once, at the greatest requested height, and
+written for every combination of height and color set as
+<out-dir>/<name>_<height>_<color set>.ldr. Workers build the palettes of
+all color sets once when they start. A JSON manifest lists every output
+with its status and signature: the options it was converted with and
+the size and mtime of the files it was made from. Outputs whose
+signature in the previous manifest still holds are skipped.
+
+usage: python batch.py 'models/*.obj' -t 40 80 160 -c all basic -j 4
+"""
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+from argparse import ArgumentParser
+from config import get_library, plate_height_ratio, plates_to_brick, \
+    COLORS_FILE
+from fill import parse_fill
+from mesh_cache import file_signature
+from pipeline import load_palette, load_voxels, convert
+
+
+# `run_batch` options that change the converted output
+OUTPUT_OPTIONS = ('plates_to_brick', 'plate_height_ratio', 'color_bins',
+                  'fill', 'merge', 'stagger', 'voxel_texture', 'blend')
+
+
+def find_inputs(patterns, list_file=None):
+    """ Input paths matching glob `patterns` and listed in `list_file`. """
+    inputs = []
+    for pattern in patterns:
+        inputs.extend(sorted(glob.glob(pattern)) or [pattern])
+    if list_file is not None:
+        with open(list_file) as f:
+            inputs.extend(line.strip() for line in f if line.strip())
+    # keep the first occurrence of every input
+    return list(dict.fromkeys(inputs))
+
+
+def plan_outputs(obj_location, heights, color_sets, out_dir):
+    """ (height, color set, output path) for every output of an input. """
+    name = os.path.splitext(os.path.basename(obj_location))[0]
+    return [(height, color_set, os.path.join(
+                out_dir, '{}_{}_{}.ldr'.format(name, height, color_set)))
+            for height in heights for color_set in color_sets]
+
+
+def output_options(height, color_set, voxel_height, options):
+    """ Options an output is converted with, as stored in its signature. """
+    output = dict(height=height, color_set=color_set,
+                  voxel_height=voxel_height,
+                  **{name: options[name] for name in OUTPUT_OPTIONS})
+    # as read back from the manifest
+    return json.loads(json.dumps(output))
+
+
+def output_signature(options, obj_location, dependencies):
+    files = [obj_location, COLORS_FILE] + list(dependencies)
+    return {'options': options,
+            'files': {path: file_signature(path) for path in files}}
+
+
+def is_up_to_date(out_file, options, previous):
+    """
+    Whether `out_file` exists and its `previous` manifest entry records it
+    was converted with `options` from files that did not change since.
+    """
+    signature = (previous or {}).get('signature')
+    if signature is None or signature['options'] != options or \
+            not os.path.exists(out_file):
+        return False
+    try:
+        return all(file_signature(path) == file
+                   for path, file in signature['files'].items())
+    except OSError:
+        return False
+
+
+def read_manifest(filename):
+    """ Entries of a manifest by output path; none if it cannot be read. """
+    try:
+        with open(filename) as f:
+            return {entry['output']: entry
+                    for entry in json.load(f)['outputs']}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+_options = None
+_palettes = None
+
+
+def _init_worker(options):
+    global _options, _palettes
+    _options = options
+    _palettes = {color_set: load_palette(color_set, options['color_bins'])
+                 for color_set in options['color_sets']}
+
+
+def _convert_input(job):
+    """
+    Converts one input to the outputs listed in `job` in a worker process.
+    Returns a manifest entry for each output.
+    """
+    obj_location, voxel_height, outputs = job
+    options = _options
+    entries = []
+    start = time.perf_counter()
+    try:
+        voxels, _ = load_voxels(obj_location, voxel_height,
+                                options['plate_height_ratio'],
+                                cache_dir=options['cache_dir'],
+                                voxel_texture=options['voxel_texture'],
+                                blend=options['blend'])
+    except Exception as e:
+        return [_entry(obj_location, output, 'failed', error=repr(e))
+                for output in outputs]
+    voxelize_time = time.perf_counter() - start
+
+    for output in outputs:
+        height, color_set, out_file = output
+        start = time.perf_counter()
+        try:
+            palette_rgb, quantizer = _palettes[color_set]
+            grid = convert(voxels, height, out_file, palette_rgb, quantizer,
+                           options['plates_to_brick'],
+                           options['plate_height_ratio'], options['fill'],
+                           options['merge'], options['stagger'],
+                           options['sparse'])
+        except Exception as e:
+            entries.append(_entry(obj_location, output, 'failed',
+                                  error=repr(e)))
+            continue
+        signature = output_signature(
+            output_options(height, color_set, voxel_height, options),
+            obj_location, voxels.dependencies)
+        entries.append(_entry(obj_location, output, 'written',
+                              signature=signature,
+                              bricks=grid.count_parts(),
+                              seconds=time.perf_counter() - start,
+                              voxelize_seconds=voxelize_time))
+    return entries
+
+
+def _entry(obj_location, output, status, **details):
+    height, color_set, out_file = output
+    return dict(input=obj_location, height=height, color_set=color_set,
+                output=out_file, status=status, **details)
+
+
+def run_batch(inputs, heights, color_sets, out_dir, jobs=None, force=False,
+              previous=None, **options):
+    """
+    Converts `inputs` on a pool of `jobs` processes and returns the
+    manifest entries, in input order. Outputs up to date with their entry
+    in `previous` (see `read_manifest`) are skipped unless `force` is set.
+    `options` are `_init_worker` options besides the color sets.
+    """
+    previous = previous or {}
+    heights = sorted(set(heights), reverse=True)
+    os.makedirs(out_dir, exist_ok=True)
+    options = dict(options, color_sets=list(dict.fromkeys(color_sets)))
+
+    entries, work = {}, []
+    for obj_location in inputs:
+        outputs = plan_outputs(obj_location, heights, color_sets, out_dir)
+        # every output is made from voxels of the greatest height, so it
+        # does not depend on which outputs are converted along with it
+        stale = [output for output in outputs if force or not is_up_to_date(
+            output[2], output_options(*output[:2], heights[0], options),
+            previous.get(output[2]))]
+        entries[obj_location] = [
+            _entry(obj_location, output, 'skipped',
+                   signature=previous[output[2]]['signature'])
+            for output in outputs if output not in stale]
+        if stale:
+            work.append((obj_location, heights[0], stale))
+
+    if work:
+        with multiprocessing.Pool(jobs, _init_worker, (options,)) as pool:
+            for job, done in zip(work, pool.imap(_convert_input, work)):
+                entries[job[0]].extend(done)
+                for entry in done:
+                    print('{status:>8} {output}'.format(**entry))
+
+    return [entry for obj_location in inputs
+            for entry in entries[obj_location]]
+
+
+def write_manifest(filename, entries):
+    counts = {}
+    for entry in entries:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    with open(filename, 'w') as f:
+        json.dump({'counts': counts, 'outputs': entries}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Convert many .obj files at once')
+    parser.add_argument(
+        'inputs', nargs='*', help='.obj files or glob patterns')
+    parser.add_argument(
+        '-l', '--list', type=str, default=None, metavar='FILE',
+        help='File listing more inputs, one per line')
+    parser.add_argument(
+        '-t', '--total-height', type=int, nargs='+', default=[80],
+        help='Heights to convert every input to')
+    parser.add_argument(
+        '-c', '--color-set', type=str, nargs='+', default=['all'],
+        help='Color sets to convert every input with')
+    parser.add_argument(
+        '-o', '--out-dir', type=str, default='.',
+        help='Directory to write the .ldr files and the manifest to')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='Number of worker processes (default: one per CPU)')
+    parser.add_argument(
+        '-b', '--bricks-only', action='store_true',
+        help='Use bricks instead of plates')
+    parser.add_argument(
+        '--color-bins', type=int, default=None,
+        help='Quantize colors through a lookup table with this many bins per '
+             'RGB channel instead of an exact palette search')
+    parser.add_argument(
+        '--cache-dir', type=str, default=None,
+        help='Directory to cache parsed meshes in between runs')
+    parser.add_argument(
+        '--voxel-texture', action='store_true',
+        help='Color each voxel with the texel under it instead of the '
+             'average texture color of its face')
+    parser.add_argument(
+        '--blend', action='store_true',
+        help='Color voxels touched by several faces with the mean of their '
+             'colors weighted by face area, instead of the last face\'s')
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Store grids in chunks allocated on first write. Does not go '
+             'with --fill, which needs the whole volume in memory')
+    parser.add_argument(
+        '--fill', type=parse_fill, default=None, metavar='solid|shell:N',
+        help='Fill closed interiors, or fill them and hollow the result '
+             'down to walls N voxels thick')
+    parser.add_argument(
+        '--merge', action='store_true',
+        help='Merge same-colored plates and bricks of a layer into larger '
+             'parts')
+    parser.add_argument(
+        '--stagger', action='store_true',
+        help='With --merge, offset the seams of alternate layers')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Convert inputs even when their outputs are up to date')
+    parser.add_argument(
+        '--manifest', type=str, default=None, metavar='FILE',
+        help='Manifest file (default: manifest.json in the output directory)')
+    args = parser.parse_args()
+
+    inputs = find_inputs(args.inputs, args.list)
+    if not inputs:
+        parser.error('no inputs given')
+    if args.sparse and args.fill is not None:
+        parser.error('--fill works on the whole volume at once, which '
+                     '--sparse is meant to avoid; use one or the other')
+    unknown = [c for c in args.color_set
+               if c not in get_library().color_sets]
+    if unknown:
+        parser.error('unknown color sets: {}'.format(', '.join(unknown)))
+
+    manifest = args.manifest or os.path.join(args.out_dir, 'manifest.json')
+    entries = run_batch(
+        inputs, args.total_height, args.color_set, args.out_dir, args.jobs,
+        args.force, read_manifest(manifest),
+        plates_to_brick=1 if args.bricks_only else plates_to_brick,
+        plate_height_ratio=plate_height_ratio, color_bins=args.color_bins,
+        cache_dir=args.cache_dir, voxel_texture=args.voxel_texture,
+        blend=args.blend, sparse=args.sparse, fill=args.fill,
+        merge=args.merge, stagger=args.stagger)
+    write_manifest(manifest, entries)
+    print('{} outputs, manifest written to {}'.format(len(entries), manifest))
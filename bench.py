@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+
+from argparse import ArgumentParser
+from PIL import Image
+from config import colors_hex, plate_height_ratio, plates_to_brick, \
+    brick_expand_jitter
+from obj_parser import load_obj_mesh, ParsedObjFile
+from grid import Scaling, Grid
+from colors import hex2rgb
+from pipeline import output_ldr
+
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'bench_golden.json')
+DEFAULT_HEIGHTS = (20, 40, 80)
+STAGES = ('parse', 'voxelize', 'normalize', 'write')
+
+
+def write_obj(path, vs, faces, vts=None, face_vts=None, material=None):
+    """
+    Writes a `.obj` file. `faces` (and `face_vts`) hold 0-based indices;
+    `material` is an optional (mtl file name, material name) pair.
+    """
+    with open(path, 'w') as f:
+        if material:
+            f.write('mtllib {}\nusemtl {}\n'.format(*material))
+        f.writelines('v {:.6f} {:.6f} {:.6f}\n'.format(*v) for v in vs)
+        if vts is not None:
+            f.writelines('vt {:.6f} {:.6f}\n'.format(*vt) for vt in vts)
+        for i, face in enumerate(faces):
+            if face_vts is None:
+                items = (str(v + 1) for v in face)
+            else:
+                items = ('{}/{}'.format(v + 1, vt + 1)
+                         for v, vt in zip(face, face_vts[i]))
+            f.write('f {}\n'.format(' '.join(items)))
+
+
+def grid_faces(rows, cols, wrap_cols=False):
+    """ Quads over a rows x cols vertex lattice. """
+    last_col = cols if wrap_cols else cols - 1
+    return [(i*cols + j, i*cols + (j + 1) % cols,
+             (i + 1)*cols + (j + 1) % cols, (i + 1)*cols + j)
+            for i in range(rows - 1) for j in range(last_col)]
+
+
+def uv_sphere(path, rings=32, segments=64):
+    theta = np.linspace(0, np.pi, rings + 1)[:, None]
+    phi = np.linspace(0, 2*np.pi, segments, endpoint=False)[None, :]
+    vs = np.stack(np.broadcast_arrays(
+        np.sin(theta)*np.cos(phi), np.cos(theta),
+        np.sin(theta)*np.sin(phi)), axis=-1).reshape(-1, 3)
+    write_obj(path, vs, grid_faces(rings + 1, segments, wrap_cols=True))
+
+
+def torus(path, rings=48, segments=24, radius=1.0, tube=0.35):
+    u = np.linspace(0, 2*np.pi, rings, endpoint=False)[:, None]
+    v = np.linspace(0, 2*np.pi, segments, endpoint=False)[None, :]
+    r = radius + tube*np.cos(v)
+    vs = np.stack(np.broadcast_arrays(
+        r*np.cos(u), tube*np.sin(v), r*np.sin(u)), axis=-1).reshape(-1, 3)
+    # close the ring of tubes by repeating the first row of vertices
+    faces = grid_faces(rings + 1, segments, wrap_cols=True)
+    faces = [tuple(i % len(vs) for i in face) for face in faces]
+    write_obj(path, vs, faces)
+
+
+def plane(path, size=128):
+    x, z = np.meshgrid(np.linspace(-1, 1, size), np.linspace(-1, 1, size),
+                       indexing='ij')
+    y = 0.2*np.sin(3*x)*np.cos(2*z) + 0.5*x + 0.3
+    vs = np.stack([x, y, z], axis=-1).reshape(-1, 3)
+    write_obj(path, vs, grid_faces(size, size))
+
+
+def textured_cube(path, texture_size=64):
+    base = os.path.splitext(path)[0]
+    texture, mtl = base + '.png', base + '.mtl'
+    i, j = np.meshgrid(np.arange(texture_size), np.arange(texture_size),
+                       indexing='ij')
+    pixels = np.stack([i*255 // texture_size, j*255 // texture_size,
+                       ((i // 8 + j // 8) % 2) * 255], axis=-1)
+    Image.fromarray(pixels.astype(np.uint8)).save(texture)
+    with open(mtl, 'w') as f:
+        f.write('newmtl cube\nKd 0.8 0.8 0.8\nmap_Kd {}\n'.format(
+            os.path.basename(texture)))
+
+    vs = [(x, y, z) for x in (0, 1) for y in (0, 1.5) for z in (0, 1)]
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1),
+             (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    vts = [(0, 0), (1, 0), (1, 1), (0, 1)]
+    write_obj(path, vs, faces, vts, [(0, 1, 2, 3)] * len(faces),
+              (os.path.basename(mtl), 'cube'))
+
+
+def small_triangles(path, count=20000, seed=7):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-1, 1, (count, 1, 3))
+    vs = (centers + rng.normal(scale=0.01, size=(count, 3, 3))).reshape(-1, 3)
+    write_obj(path, vs, np.arange(len(vs)).reshape(-1, 3))
+
+
+MESHES = {
+    'uv_sphere': uv_sphere,
+    'torus': torus,
+    'plane': plane,
+    'textured_cube': textured_cube,
+    'small_triangles': small_triangles,
+}
+
+
+def grid_hash(grid):
+    """ Hash of the grid's cells, independent of how the grid stores them. """
+    digest = hashlib.sha256(repr(tuple(int(d) for d in grid.shape)).encode())
+    for layer in grid.get_cells_by_layer():
+        digest.update(b'|'.join(np.asarray(values, dtype=np.int64).tobytes()
+                                for values in layer))
+    return digest.hexdigest()
+
+
+def timed(stages, name, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    stages[name] = time.perf_counter() - start
+    return result
+
+
+def run_case(obj_path, height, palette_rgb, out_path):
+    stages = {}
+    obj_file = timed(stages, 'parse', lambda path: ParsedObjFile.from_mesh(
+        load_obj_mesh(path)), obj_path)
+    scaling = Scaling(obj_file.vs.bounds, plate_height_ratio, height)
+    grid = timed(stages, 'voxelize', Grid.create, scaling, obj_file,
+                 palette_rgb, brick_expand_jitter)
+    timed(stages, 'normalize', grid.normalize, plates_to_brick)
+    timed(stages, 'write', output_ldr, out_path, grid, palette_rgb)
+
+    return {
+        'faces': len(obj_file.faces),
+        'grid_dimensions': [int(d) for d in grid.shape],
+        'bricks': grid.count_parts(),
+        'hash': grid_hash(grid),
+        'stages': stages,
+    }
+
+
+def best_of(runs):
+    best = dict(runs[0])
+    best['stages'] = {stage: min(run['stages'][stage] for run in runs)
+                      for stage in STAGES}
+    return best
+
+
+def main():
+    parser = ArgumentParser(description='Time each pybox pipeline stage on '
+                            'synthetic meshes')
+    parser.add_argument(
+        '-m', '--meshes', nargs='+', choices=sorted(MESHES),
+        default=sorted(MESHES), help='meshes to run')
+    parser.add_argument(
+        '-t', '--heights', nargs='+', type=int, default=DEFAULT_HEIGHTS,
+        help='total heights to run every mesh at')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=1,
+        help='runs per case; the fastest time of each stage is reported')
+    parser.add_argument(
+        '-o', '--out', type=str, default='bench_results.json',
+        help='JSON results file')
+    parser.add_argument(
+        '--update-golden', action='store_true',
+        help='record the voxel hashes of this run as the golden ones')
+    args = parser.parse_args()
+
+    golden = {}
+    if os.path.exists(GOLDEN_FILE):
+        with open(GOLDEN_FILE) as f:
+            golden = json.load(f)
+
+    palette_rgb = [hex2rgb(c) for c in colors_hex]
+    results = []
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mesh in args.meshes:
+            obj_path = os.path.join(tmp_dir, mesh + '.obj')
+            MESHES[mesh](obj_path)
+            for height in args.heights:
+                out_path = os.path.join(tmp_dir, mesh + '.ldr')
+                result = best_of([run_case(obj_path, height, palette_rgb,
+                                           out_path)
+                                  for _ in range(args.repeat)])
+                key = '{}@{}'.format(mesh, height)
+                result.update(mesh=mesh, height=height,
+                              golden=golden.get(key) == result['hash']
+                              if key in golden else None)
+                if args.update_golden:
+                    golden[key] = result['hash']
+                elif result['golden'] is False:
+                    mismatches += 1
+                results.append(result)
+
+                print('{:<24} {}  {}'.format(
+                    key, '  '.join('{}={:.3f}s'.format(s, result['stages'][s])
+                                   for s in STAGES),
+                    {True: 'ok', False: 'MISMATCH', None: 'no golden'}[
+                        result['golden']]))
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'timestamp': time.time(),
+            'results': results,
+        }, f, indent=2)
+
+    if args.update_golden:
+        with open(GOLDEN_FILE, 'w') as f:
+            json.dump(golden, f, indent=2, sort_keys=True)
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,5 @@
 import numpy as np
 
-from PIL import ImageColor
 from util import Point
 from config import texture_default_color
 
@@ -10,13 +9,19 @@ def rgb2hex(rgb):
 
 
 def hex2rgb(hex_):
+    if len(hex_) == 7 and hex_[0] == '#':
+        return tuple(int(hex_[i:i + 2], 16) for i in (1, 3, 5))
+    # other color forms are rare; PIL is slow to import
+    from PIL import ImageColor
     return ImageColor.getrgb(hex_)
 
 
 def nearest_color_code(rgb_color, palette_rgb):
-    index = np.argmin([color_distance(ref_rgb, rgb_color)
-                       for ref_rgb in palette_rgb])
-    return palette_rgb[index]
+    return palette_rgb[nearest_color_index(rgb_color, palette_rgb)]
+
+
+def nearest_color_index(rgb_color, palette_rgb):
+    return int(np.argmin(color_distances(palette_rgb, [rgb_color])[0]))
 
 
 def color_distance(rgb1, rgb2):
@@ -35,14 +40,87 @@ def color_distance(rgb1, rgb2):
     return np.sum(coeffs * (delta ** 2)) + residue
 
 
+def color_distances(palette_rgb, colors):
+    """ Vectorized `color_distance` between every color of an (N, 3)
+    array and every palette color; returns an (N, P) array.
+    """
+
+    ref = np.asarray(palette_rgb, dtype=float)[None]
+    col = np.asarray(colors, dtype=float)[:, None]
+    delta = col - ref
+    r = (ref[..., 0] + col[..., 0]) / 2
+    residue = (r * (delta[..., 0] ** 2 - delta[..., 2] ** 2)) / 256
+    sq = delta ** 2
+
+    return 2 * sq[..., 0] + 4 * sq[..., 1] + 3 * sq[..., 2] + residue
+
+
+class PaletteQuantizer:
+    """
+    Maps RGB colors to palette indices. The redmean distances are computed
+    once for the center of every bin of a `bins`^3 quantized RGB cube, so
+    quantizing is a table lookup per color. With `exact` the table is
+    skipped and every color is searched against the whole palette, which
+    gives the same answer as `nearest_color_index`.
+    """
+
+    CHUNK = 1 << 16
+
+    def __init__(self, palette_rgb, bins=64, exact=False):
+        self.palette_rgb = list(palette_rgb)
+        self.bins = bins
+        self.exact = exact
+        self.table = None if exact else self._build_table()
+
+    def _build_table(self):
+        centers = (np.arange(self.bins) + 0.5) * (256 / self.bins)
+        cube = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'),
+                        axis=-1).reshape(-1, 3)
+        dtype = np.uint8 if len(self.palette_rgb) <= 256 else np.uint16
+        return self._search(cube).astype(dtype).reshape((self.bins,) * 3)
+
+    def _search(self, colors):
+        return np.concatenate(
+            [np.argmin(color_distances(self.palette_rgb,
+                                       colors[i:i + self.CHUNK]), axis=1)
+             for i in range(0, len(colors), self.CHUNK)] or
+            [np.empty(0, dtype=int)])
+
+    def quantize(self, colors):
+        """ Palette indices of an (N, 3) array of RGB colors. """
+        colors = np.asarray(colors, dtype=float).reshape(-1, 3)
+        if self.exact:
+            return self._search(colors)
+
+        bins = np.clip((colors * (self.bins / 256)).astype(int),
+                       0, self.bins - 1)
+        return self.table[bins[:, 0], bins[:, 1], bins[:, 2]].astype(int)
+
+
 def compute_face_colors(face, vts):
     if not face.texture_info:
         return [texture_default_color] if face.Kd is None else [face.Kd]
 
-    pixel_values, w, h = \
-        face.texture_info.data, face.texture_info.w, face.texture_info.h
-    get_rgb = lambda x, y: pixel_values[y * w + x]
-    get_vts = lambda face_component: vts[face_component.vt][:2]
+    return sample_texture(face.texture_info,
+                          [vts[fc.vt][:2] for fc in face.components])
+
+
+def sample_face_texture(face, vts, weights):
+    """ Texel colors of a textured face at the points given by (M, k)
+    weights of its k vertices, returned as an (M, 3) uint8 array.
+    """
+
+    uvs = np.array([vts[fc.vt][:2] for fc in face.components], dtype=float)
+    return sample_texture(face.texture_info, weights @ uvs)
+
+
+def sample_texture(texture_info, uvs):
+    """ Nearest texel colors of a texture for an (..., 2) array of UV
+    coordinates, returned as an (..., 3) uint8 array.
+    """
 
-    return [get_rgb(*np.round((xp*(w-1), (1-yp)*(h-1))).astype(int))
-            for xp, yp in map(get_vts, face.components)]
+    uvs = np.asarray(uvs, dtype=float)
+    w, h = texture_info.w, texture_info.h
+    x = np.round(uvs[..., 0] * (w - 1)).astype(int)
+    y = np.round((1 - uvs[..., 1]) * (h - 1)).astype(int)
+    return texture_info.data[np.clip(y, 0, h - 1), np.clip(x, 0, w - 1)]
@@ -1,4 +1,6 @@
-import yaml
+import json
+import os
+import tempfile
 
 # This is the unit distance for a plate (i.e. width and depth).
 # This will be used to position plate spacing in the resulting 3D grid.
@@ -15,14 +17,8 @@ plate_height_ratio = 1.2
 # skipped (leaving everything as a plate, above)
 plates_to_brick = 3
 
-# desired color palette
-colors_hex = [
-  '#000000', #black
-  '#FFFFFF', #white
-  '#FF0000', #red
-  '#00FF00', #green
-  '#0000FF', #blue
-]
+# desired color palette: `colors_hex` holds every color of colors.yaml,
+# read on first use (see `__getattr__` below)
 
 
 
@@ -45,15 +41,21 @@ colors_id = [
   1,
 ]
 
+COLORS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'colors.yaml')
+# colors.yaml as JSON, rebuilt whenever colors.yaml changes
+COLORS_CACHE = os.path.join(os.path.dirname(COLORS_FILE), '__pycache__',
+                            'colors.yaml.json')
+
+
 class ColorLibrary(object):
-    def __init__(self):
-        with open("colors.yaml", 'r') as stream:
-            color_config = yaml.load(stream)
-            self.colors = color_config['colors']
-            self.color_sets = color_config['color_sets']
-            self.color_sets['all'] = []
-            for one in self.colors:
-                self.color_sets['all'].append(one)
+    def __init__(self, filename=COLORS_FILE):
+        color_config = load_color_config(filename)
+        self.colors = color_config['colors']
+        self.color_sets = color_config['color_sets']
+        self.color_sets['all'] = []
+        for one in self.colors:
+            self.color_sets['all'].append(one)
 
     def set_to_hex(self, one_set):
         ret = []
@@ -61,5 +63,54 @@ class ColorLibrary(object):
             ret.append(self.colors[c])
         return ret
 
-library = ColorLibrary()
-colors_hex = library.set_to_hex('all')
+
+def load_color_config(filename=COLORS_FILE, cache=COLORS_CACHE):
+    """
+    Contents of a colors YAML file. Parsing YAML is slow, so the contents
+    are kept as JSON in `cache` along with the file's size and mtime, and
+    read from there while those match.
+    """
+    stat = os.stat(filename)
+    signature = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached['signature'] == signature:
+            return cached['config']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import yaml
+    with open(filename, 'r') as stream:
+        color_config = yaml.safe_load(stream)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(cache))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'signature': signature, 'config': color_config}, f)
+        os.replace(tmp_name, cache)
+    except OSError:
+        pass
+    return color_config
+
+
+_library = None
+
+
+def get_library():
+    """ The ColorLibrary of colors.yaml, read once. """
+    global _library
+    if _library is None:
+        _library = ColorLibrary()
+    return _library
+
+
+def __getattr__(name):
+    # `library` and `colors_hex` used to be read at import time; they are
+    # now only read when something uses them
+    if name == 'library':
+        return get_library()
+    if name == 'colors_hex':
+        return get_library().set_to_hex('all')
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
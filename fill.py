@@ -0,0 +1,104 @@
+import numpy as np
+
+from collections import namedtuple
+
+
+# a `--fill` value: mode 'solid', with thickness None, or mode 'shell' with
+# the thickness of the walls to keep
+Fill = namedtuple("Fill", ['mode', 'thickness'])
+
+
+def exterior(occupied):
+    """
+    Empty cells connected to the outside of the grid through other empty
+    cells (6-connectivity). Flood fills with whole-array line sweeps: along
+    each axis in turn, every run of empty cells that contains an exterior
+    cell becomes exterior, until a full round changes nothing.
+    """
+    empty = ~occupied
+    outside = np.zeros_like(empty)
+    for axis in range(3):
+        edges = [slice(None)] * 3
+        for edge in (0, -1):
+            edges[axis] = edge
+            outside[tuple(edges)] = empty[tuple(edges)]
+
+    changed = True
+    while changed:
+        changed = False
+        for axis in range(3):
+            swept = _sweep(np.moveaxis(empty, axis, -1),
+                           np.moveaxis(outside, axis, -1))
+            swept = np.moveaxis(swept, -1, axis)
+            if np.count_nonzero(swept) != np.count_nonzero(outside):
+                changed = True
+                outside = swept
+    return outside
+
+
+def _sweep(empty, outside):
+    # label the runs of empty cells along the last axis, never letting a
+    # run continue from the end of one line into the next
+    starts = empty.copy()
+    starts[..., 1:] &= ~empty[..., :-1]
+    run_ids = np.cumsum(starts.ravel()).reshape(empty.shape) - 1
+    if not empty.any():
+        return outside
+    reached = np.bincount(run_ids[outside], minlength=run_ids.max() + 1)
+    return empty & (reached[np.maximum(run_ids, 0)] > 0)
+
+
+def interior(occupied):
+    """ Empty cells enclosed by occupied ones. """
+    return ~occupied & ~exterior(occupied)
+
+
+def wall_distance(solid, limit):
+    """
+    City-block distance (in voxels) from every solid cell to the nearest
+    non-solid cell or the outside of the grid, capped at `limit` + 1.
+    Computed by repeated erosion; 0 for non-solid cells.
+    """
+    distance = np.zeros(solid.shape, dtype=np.int32)
+    eroded = solid
+    for step in range(1, limit + 2):
+        distance[eroded] = step
+        padded = np.pad(eroded, 1, constant_values=False)
+        eroded = eroded & \
+            padded[:-2, 1:-1, 1:-1] & padded[2:, 1:-1, 1:-1] & \
+            padded[1:-1, :-2, 1:-1] & padded[1:-1, 2:, 1:-1] & \
+            padded[1:-1, 1:-1, :-2] & padded[1:-1, 1:-1, 2:]
+        if not eroded.any():
+            break
+    return distance
+
+
+def shell(solid, thickness):
+    """ Solid cells within `thickness` voxels of the solid's surface. """
+    distance = wall_distance(solid, thickness)
+    return solid & (distance <= thickness)
+
+
+def fill_colors(colors, occupied, targets):
+    """
+    Colors for `targets` cells copied from the nearest occupied cell below
+    them in the same column, or above when there is none below.
+    """
+    ys = np.arange(colors.shape[1]).reshape(1, -1, 1)
+    below = np.maximum.accumulate(np.where(occupied, ys, -1), axis=1)
+    above = np.flip(np.minimum.accumulate(np.flip(
+        np.where(occupied, ys, colors.shape[1]), axis=1), axis=1), axis=1)
+    source = np.where(below >= 0, below,
+                      np.minimum(above, colors.shape[1] - 1))
+    filled = np.take_along_axis(colors, source, axis=1)
+    return filled[targets]
+
+
+def parse_fill(value):
+    """ Parses a `--fill` value, 'solid' or 'shell:N', into a Fill. """
+    if value == 'solid':
+        return Fill('solid', None)
+    mode, _, thickness = value.partition(':')
+    if mode != 'shell' or not thickness.isdigit() or int(thickness) < 1:
+        raise ValueError("fill must be 'solid' or 'shell:N' with N >= 1")
+    return Fill('shell', int(thickness))
@@ -3,10 +3,16 @@ import itertools as it
 import numpy as np
 
 from util import Point
-from intersect import intersects_box
+from intersect import intersects_boxes
+import fill
+from storage import DenseStorage, ChunkedStorage
+from voxel_state import VoxelState
+from profiling import Profiler, get_profiler, set_profiler
 from config import unit_distance, plate_height_ratio, plates_to_brick
-from colors import nearest_color_code, compute_face_colors
-import progressbar
+from colors import PaletteQuantizer, compute_face_colors, \
+    sample_face_texture
+from reporter import ProgressReporter
+from obj_parser import FaceList
 
 class Scaling:
     """
@@ -23,18 +29,32 @@ class Scaling:
         self.scale = (height / bounds.range_.y) * self.ratio
         self.grid_dimensions = Point.as_int(
             np.ceil(self.scale * bounds.range_))
+        # plain arrays for the batched transforms: world size of a cell,
+        # world position of grid point 0 and the highest grid index
+        self.cell = np.asarray(bounds.range_ / self.grid_dimensions,
+                               dtype=float)
+        self.origin = np.asarray(bounds.lo, dtype=float)
+        self._scale = np.asarray(self.scale, dtype=float)
+        self._grid_max = np.asarray(self.grid_dimensions - 1)
 
     def to_world_point(self, grid_point):
-        ratio = self.bounds.range_ / self.grid_dimensions
-        return ratio * grid_point + self.bounds.lo
+        return Point(self.to_world_points(grid_point))
+
+    def to_world_points(self, grid_points):
+        """ World positions of an (N, 3) array of grid points. """
+        return self.cell * grid_points + self.origin
 
     def scale_down(self, world_point):
         return world_point * self.scale
 
     def to_grid_point(self, world_point):
-        val = self.scale_down(world_point - self.bounds.lo)
-        grid_index = (0, 0, 0), self.grid_dimensions - 1
-        return Point.as_int(np.clip(np.round(val), *grid_index))
+        return Point.as_int(self.to_grid_points(world_point))
+
+    def to_grid_points(self, world_points):
+        """ Grid cells of an (N, 3) array of world points, as int. """
+        val = (np.asarray(world_points, dtype=float) - self.origin) * \
+            self._scale
+        return np.clip(np.round(val), 0, self._grid_max).astype(int)
 
 
 class GridObject:
@@ -45,107 +65,733 @@ class GridObject:
 
     BRICK_LARGE = '3005.dat'
     BRICK_SMALL = '30008.dat'
+
+    # parts spanning several cells of a layer, by the 1x1 part of the same
+    # height they replace and by footprint (cells along x, cells along z).
+    # Their long side is along x, as laid out in the LDraw library
+    MERGED_PARTS = {
+        BRICK_SMALL: {(4, 2): '3020.dat', (2, 2): '3022.dat',
+                      (4, 1): '3710.dat', (2, 1): '3023.dat'},
+        BRICK_LARGE: {(4, 2): '3001.dat', (2, 2): '3003.dat',
+                      (4, 1): '3010.dat', (2, 1): '3004.dat'},
+    }
+
     BRICK_HEIGHTS = {
         BRICK_LARGE: plates_to_brick * unit_distance * plate_height_ratio,
         BRICK_SMALL: unit_distance * plate_height_ratio
     }
+    BRICK_HEIGHTS.update(dict.fromkeys(MERGED_PARTS[BRICK_SMALL].values(),
+                                       BRICK_HEIGHTS[BRICK_SMALL]))
+    BRICK_HEIGHTS.update(dict.fromkeys(MERGED_PARTS[BRICK_LARGE].values(),
+                                       BRICK_HEIGHTS[BRICK_LARGE]))
+    BRICK_TYPES = (BRICK_SMALL, BRICK_LARGE) + \
+        tuple(MERGED_PARTS[BRICK_SMALL].values()) + \
+        tuple(MERGED_PARTS[BRICK_LARGE].values())
+    FOOTPRINTS = {part: footprint for footprint, part in it.chain(
+        MERGED_PARTS[BRICK_SMALL].items(), MERGED_PARTS[BRICK_LARGE].items())}
+
+    # a quarter turn about the y axis, for parts with their long side on z
+    ROTATED_MATRIX_STR = '0 0 1 0 1 0 -1 0 0'
 
-    def __init__(self, color, brick_type):
+    def __init__(self, color, brick_type, rotated=False):
         self.color = color
         self.brick_type = brick_type
+        self.rotated = rotated
+
+    @property
+    def footprint(self):
+        """ Cells covered along x and z, counted from the object's cell. """
+        x, z = GridObject.FOOTPRINTS.get(self.brick_type, (1, 1))
+        return (z, x) if self.rotated else (x, z)
 
     def to_ldr_repr(self, matrix_str, position_3d, encode_rgb_callable):
-        print(plate_height_ratio)
         x, y, z = position_3d
         height = GridObject.BRICK_HEIGHTS[self.brick_type]
+        size_x, size_z = self.footprint
         return '1 {color} {x} {y} {z} {matrix} {brick}'.format(
                 color=encode_rgb_callable(self.color),
-                x=x*Grid.UNIT_WIDTH,
+                x=x*Grid.UNIT_WIDTH + (size_x - 1)*Grid.UNIT_WIDTH//2,
                 y=-(y*Grid.UNIT_HEIGHT + height),
-                z=z*Grid.UNIT_DEPTH,
-                matrix=matrix_str,
+                z=z*Grid.UNIT_DEPTH + (size_z - 1)*Grid.UNIT_DEPTH//2,
+                matrix=GridObject.ROTATED_MATRIX_STR if self.rotated
+                else matrix_str,
                 brick=self.brick_type)
 
 
-class Grid(np.ndarray):
+class Grid:
     """
     Lego grid, composed of GridObjects. Keeps elements in an array where
     the first item represents the x component, second y and third z.
     This makes it easy to query the grid by: grid[(x, y, z)].
 
     (0, 0, 0) represents the (leftmost, bottommost, front) brick.
+
+    Cells are stored compactly as a palette index array (`colors`) and a
+    brick type array (`bricks`, indexing GridObject.BRICK_TYPES), with
+    sentinel values for empty cells. GridObjects are only materialized
+    when a cell is read or assigned through indexing. Both arrays are
+    dense, or with `sparse` chunked storages that only allocate the parts
+    of the grid that are written (see storage.py).
+
+    After `merge_footprints`, a part covering several cells is stored in
+    the cell with its lowest x and z, with the ROTATED bit set when it is
+    turned a quarter about y; its other cells keep their color and hold
+    COVERED, and read as None through indexing.
     """
 
     UNIT_HEIGHT = unit_distance*plate_height_ratio
     UNIT_WIDTH = unit_distance
     UNIT_DEPTH = unit_distance
 
-    def __new__(cls, dimension_tuple):
-        obj = np.empty(dimension_tuple, dtype=GridObject).view(cls)
-        return obj
+    EMPTY_BRICK = np.iinfo(np.uint8).max
+    COVERED = EMPTY_BRICK - 1
+    ROTATED = 0x80
+
+    def __init__(self, dimension_tuple, palette_rgb, sparse=False):
+        self.palette_rgb = list(palette_rgb)
+        color_dtype = np.uint8 if len(self.palette_rgb) < \
+            np.iinfo(np.uint8).max else np.uint16
+        self.empty_color = np.iinfo(color_dtype).max
+        self.sparse = sparse
+        storage = ChunkedStorage if sparse else DenseStorage
+        self.colors = storage(dimension_tuple, color_dtype, self.empty_color)
+        self.bricks = storage(dimension_tuple, np.uint8, Grid.EMPTY_BRICK)
+
+        self._palette_index = {}
+        for i, rgb in enumerate(self.palette_rgb):
+            self._palette_index.setdefault(tuple(rgb), i)
+
+    @property
+    def shape(self):
+        return self.bricks.shape
+
+    def count_occupied(self):
+        """ Number of non-empty cells, including those COVERED by parts. """
+        return self.bricks.count()
+
+    def count_parts(self):
+        """ Number of parts, i.e. of lines `LdrWriter` writes. """
+        return self.bricks.count(ignore=(Grid.COVERED,))
+
+    def __getitem__(self, pos):
+        pos = tuple(pos)
+        brick = int(self.bricks[pos])
+        if brick in (Grid.EMPTY_BRICK, Grid.COVERED):
+            return None
+        return GridObject(self.palette_rgb[self.colors[pos]],
+                          GridObject.BRICK_TYPES[brick & ~Grid.ROTATED],
+                          bool(brick & Grid.ROTATED))
+
+    def __setitem__(self, pos, grid_object):
+        pos = tuple(pos)
+        if grid_object is None:
+            self.colors[pos] = self.empty_color
+            self.bricks[pos] = Grid.EMPTY_BRICK
+            return
+
+        brick = GridObject.BRICK_TYPES.index(grid_object.brick_type)
+        if grid_object.rotated:
+            brick |= Grid.ROTATED
+        self.set_cell(pos, self._palette_index[tuple(grid_object.color)],
+                      brick)
+
+    def set_cell(self, pos, color_index, brick_index):
+        self.colors[pos] = color_index
+        self.bricks[pos] = brick_index
 
     def get_bricks_by_layer(self):
-        xdim, ydim, zdim = self.shape
-        grid_iter_by_y_layer = it.product(
-            *(range(dim) for dim in (ydim, zdim, xdim)))
-        bricks_by_layer_asc = (
-            Point.as_int((x, y, z))
-            for (y, z, x) in grid_iter_by_y_layer if self[(x, y, z)])
+        return (Point.as_int((x, y, z))
+                for y, xs, zs, _, _ in self.get_cells_by_layer()
+                for x, z in zip(xs, zs))
 
-        return bricks_by_layer_asc
+    def get_cells_by_layer(self, rows=16):
+        """
+        Yields (y, xs, zs, colors, bricks) arrays for every non-empty layer
+        in ascending order, cells ordered by z and then x. Cells are
+        gathered `rows` layers at a time.
+        """
+        for y_lo in range(0, self.shape[1], rows):
+            xs, ys, zs, bricks = self.bricks.cells(y_lo, y_lo + rows)
+            order = np.lexsort((xs, zs, ys))
+            xs, ys, zs, bricks = xs[order], ys[order], zs[order], bricks[order]
+            colors = self.colors[xs, ys, zs]
+            layer_starts = np.flatnonzero(np.diff(ys, prepend=-1))
+            for start, stop in zip(layer_starts,
+                                   list(layer_starts[1:]) + [len(ys)]):
+                yield int(ys[start]), xs[start:stop], zs[start:stop], \
+                    colors[start:stop], bricks[start:stop]
 
     def normalize(self, plates_to_brick):
-        grid = self
-        valid_rows = lambda pt: pt.y >= plates_to_brick - 1
+        """
+        Replaces `plates_to_brick` same-colored plates stacked vertically by
+        one brick. Every vertical run of same-colored cells is cut into
+        bricks from its bottom up; leftover plates stay on top of the run.
+        Works through the grid in boxes spanning its full height.
+        """
+        profiler = get_profiler()
+        for lo, hi in self.bricks.column_boxes():
+            colors = self.colors.read_box(lo, hi)
+            bricks = self.bricks.read_box(lo, hi)
+            in_brick, bottoms = merge_plates(
+                colors, bricks, plates_to_brick, self.empty_color)
+            self.colors.write_box(lo, colors)
+            self.bricks.write_box(lo, bricks)
 
-        for pt in filter(valid_rows, grid.get_bricks_by_layer()):
-            gen_pt = lambda i: (pt.x, pt.y - i, pt.z)
-            same_color = lambda i, j: np.allclose(
-                grid[i].color, grid[j].color)
+            if profiler.enabled:
+                profiler.count('voxels_merged', np.count_nonzero(in_brick))
+                profiler.count('bricks_merged', np.count_nonzero(bottoms))
 
-            plates_to_replace = [gen_pt(i) for i in range(plates_to_brick)]
-            bottom = plates_to_replace[-1]
+        return self
 
-            if all(grid[i] for i in plates_to_replace) \
-                    and all(same_color(i, bottom) for i in plates_to_replace):
-                for replace_pt in plates_to_replace[:-1]:
-                    grid[replace_pt] = None
+    def merge_footprints(self, stagger=False, rows=16):
+        """
+        Merges same-colored plates, and same-colored bricks, of a layer into
+        the larger parts of GridObject.MERGED_PARTS, largest first. With
+        `stagger`, odd layers start tiling half a part further along, so
+        that seams do not line up between layers. Run after `normalize`.
+        Works through the grid `rows` layers at a time.
+        """
+        profiler = get_profiler()
+        xdim, ydim, zdim = self.shape
+        for y_lo in range(0, ydim, rows):
+            lo, hi = (0, y_lo, 0), (xdim, min(y_lo + rows, ydim), zdim)
+            colors = self.colors.read_box(lo, hi)
+            bricks = self.bricks.read_box(lo, hi)
+            parts, covered = merge_layer_footprints(
+                colors, bricks, y_lo, stagger)
+            profiler.count('parts_merged', parts)
+            profiler.count('cells_covered', covered)
+            self.bricks.write_box(lo, bricks)
 
-                grid[bottom] = GridObject(
-                    grid[bottom].color, GridObject.BRICK_LARGE)
+        return self
 
-        return grid
+    def fill(self, thickness=None):
+        """
+        Fills the closed interiors of the model. With `thickness`, the
+        solid is then hollowed so that only walls `thickness` voxels thick
+        remain. Works on a dense copy of the whole grid, also when sparse.
+        """
+        lo, hi = (0, 0, 0), self.shape
+        colors = self.colors.read_box(lo, hi)
+        bricks = self.bricks.read_box(lo, hi)
+        occupied = bricks != Grid.EMPTY_BRICK
+
+        inside = fill.interior(occupied)
+        solid = occupied | inside
+        keep = solid if thickness is None else fill.shell(solid, thickness)
+
+        added = inside & keep
+        colors[added] = fill.fill_colors(colors, occupied, added)
+        bricks[added] = GridObject.BRICK_TYPES.index(GridObject.BRICK_SMALL)
+        removed = occupied & ~keep
+        colors[removed] = self.empty_color
+        bricks[removed] = Grid.EMPTY_BRICK
+
+        self.colors.write_box(lo, colors)
+        self.bricks.write_box(lo, bricks)
+
+        profiler = get_profiler()
+        profiler.count('voxels_filled', np.count_nonzero(added))
+        profiler.count('voxels_hollowed', np.count_nonzero(removed))
+        return self
+
+    def write_cells(self, positions, color_indices, brick_index):
+        """
+        Writes cells given as an (N, 3) position array in order; when a
+        position repeats, the last write wins.
+        """
+        if not len(positions):
+            return
+        last = last_writes(positions, self.shape)
+        pos = tuple(positions[last].T)
+        self.colors[pos] = color_indices[last]
+        self.bricks[pos] = brick_index
 
     @staticmethod
-    def create(scaling, parsed_obj, palette_rgb, jitter):
-        grid = Grid(scaling.grid_dimensions)
+    def voxelize(scaling, parsed_obj, jitter, workers=1, progress=None,
+                 voxel_texture=False, blend=False):
+        """
+        Voxelizes `parsed_obj` into a VoxelState: the cells its faces touch,
+        each with the unquantized color of the last face written to it, or
+        with `blend` the mean color of all of them weighted by face area
+        (see `voxelize_faces` for `voxel_texture`).
+        """
+        progress = progress or ProgressReporter()
+        faces = parsed_obj.faces
         vs = parsed_obj.vs.values
         vts = parsed_obj.vts.values
 
-        progress = progressbar.ProgressBar(max_value=len(parsed_obj.faces), redirect_stdout=True)
-        face_count = 0
-        for face in parsed_obj.faces:
-            progress.update(face_count)
-            face_count += 1
-            for pos in to_blocks(scaling, [vs[fc.v] for fc in face], jitter):
-                pos = tuple(pos)
-                color = np.average(compute_face_colors(face, vts), axis=0)
-                grid[pos] = GridObject(
-                    nearest_color_code(color, palette_rgb),
-                    GridObject.BRICK_SMALL)
-        print()
+        profiler = get_profiler()
+        progress.start('voxelize', len(faces))
+        if workers > 1 and len(faces):
+            # contiguous shards merged in order keep the serial last-write-wins
+            # result; extra shards per worker even out the load
+            shard_size = max(1, -(-len(faces) // (workers * 4)))
+            shards = [_shard(faces, i, i + shard_size)
+                      for i in range(0, len(faces), shard_size)]
+            # textures go to every worker once, not with every shard
+            textures, kds = (faces.textures, faces.kds) \
+                if isinstance(faces, FaceList) else (None, None)
+            args = (scaling, vs, vts, textures, kds, jitter, voxel_texture,
+                    blend, profiler.enabled)
+            import multiprocessing
+            with multiprocessing.Pool(workers, _init_worker, args) as pool:
+                results = []
+                for *result, counters in pool.imap(_voxelize_shard, shards):
+                    results.append(result)
+                    profiler.merge(counters)
+                    progress.update(
+                        min(len(results) * shard_size, len(faces)))
+        else:
+            results = [voxelize_faces(scaling, faces, vs, vts, jitter,
+                                      progress.update, voxel_texture, blend)]
+
+        positions, rgb, *weights = (np.concatenate(part)
+                                    for part in zip(*results))
+        shape = tuple(int(d) for d in scaling.grid_dimensions)
+        profiler.count('voxels_written', len(positions))
+        if blend:
+            positions, rgb, counts = blend_writes(
+                positions, rgb, weights[0], shape)
+            profiler.count('voxels_blended', np.count_nonzero(counts > 1))
+        else:
+            last = last_writes(positions, shape)
+            profiler.count('voxels_overwritten', len(positions) - len(last))
+            positions, rgb = positions[last], rgb[last]
+        progress.finish()
+        return VoxelState(shape, positions, rgb, scaling.bounds)
+
+    @staticmethod
+    def from_voxels(voxels, palette_rgb, quantizer=None, sparse=False):
+        """ Grid of 1x1 plates for `voxels` in the colors of `palette_rgb`. """
+        grid = Grid(voxels.shape, palette_rgb, sparse)
+        if quantizer is None:
+            quantizer = PaletteQuantizer(palette_rgb, exact=True)
+        if len(voxels.positions):
+            grid.set_cell(tuple(voxels.positions.T),
+                          quantizer.quantize(voxels.rgb),
+                          GridObject.BRICK_TYPES.index(GridObject.BRICK_SMALL))
         return grid
 
+    @staticmethod
+    def create(scaling, parsed_obj, palette_rgb, jitter, workers=1,
+               quantizer=None, progress=None, sparse=False,
+               voxel_texture=False, blend=False):
+        voxels = Grid.voxelize(scaling, parsed_obj, jitter, workers, progress,
+                               voxel_texture, blend)
+        return Grid.from_voxels(voxels, palette_rgb, quantizer, sparse)
+
+
+def last_writes(positions, shape):
+    """
+    Indices of the last write to every distinct cell of an (N, 3) array of
+    written positions, in cell order.
+    """
+    flat = np.ravel_multi_index(tuple(positions.T), shape)
+    # np.unique keeps the first occurrence, so search the writes reversed
+    _, last = np.unique(flat[::-1], return_index=True)
+    return len(flat) - 1 - last
+
+
+def blend_writes(positions, rgb, weights, shape):
+    """
+    Distinct cells of an (N, 3) array of written positions, in cell order,
+    with the mean of the colors written to each weighted by `weights`, and
+    the number of writes to each. Cells whose writes all weigh 0 take the
+    plain mean. The sums do not depend on which face came last.
+    """
+    flat = np.ravel_multi_index(tuple(positions.T), shape)
+    cells, first, inverse, counts = np.unique(
+        flat, return_index=True, return_inverse=True, return_counts=True)
+    size = len(cells)
+    # accumulation buffers of the weighted and plain sums of every channel
+    totals = np.bincount(inverse, weights, size)
+    sums = np.stack([np.bincount(inverse, weights * rgb[:, c], size)
+                     for c in range(3)], axis=1)
+    plain = np.stack([np.bincount(inverse, rgb[:, c], size)
+                      for c in range(3)], axis=1)
+    weighted = totals > 0
+    mean = plain / counts[:, None]
+    mean[weighted] = sums[weighted] / totals[weighted, None]
+    return positions[first], mean, counts
+
+
+def merge_plates(colors, bricks, plates_to_brick, empty_color, below=None):
+    """
+    Vectorized plate-to-brick merging of `Grid.normalize` on one box of
+    color and brick arrays spanning the full grid height, in place.
+    Returns the masks of cells merged into bricks and of the brick cells.
+
+    For a box starting above the bottom of the grid, `below` gives the
+    (x, z) colors of the layer under the box and the length of the run
+    each of its cells ends, 0 for empty cells. Runs reaching the top of
+    the box are cut as if they ended there.
+    """
+    occupied = bricks != Grid.EMPTY_BRICK
+    ydim = colors.shape[1]
+    ys = np.arange(ydim).reshape(1, -1, 1)
+
+    differs = np.ones(colors.shape, dtype=bool)
+    differs[:, 1:] = ~occupied[:, :-1] | (colors[:, 1:] != colors[:, :-1])
+    # runs continuing from below the box started that many cells earlier
+    run_base = 0
+    if below is not None:
+        below_colors, below_lengths = below
+        differs[:, 0] = (below_lengths == 0) | (colors[:, 0] != below_colors)
+        run_base = -below_lengths[:, None, :]
+    # differs[:, y] tells if cell y starts a new run over cell y - 1
+    starts = occupied & differs
+    ends = np.ones(colors.shape, dtype=bool)
+    ends[:, :-1] = differs[:, 1:]
+    ends &= occupied
+
+    run_start = np.maximum.accumulate(
+        np.where(starts, ys, run_base), axis=1)
+    run_end = np.flip(np.minimum.accumulate(
+        np.flip(np.where(ends, ys, ydim), axis=1), axis=1), axis=1)
+
+    offset = ys - run_start
+    length = run_end - run_start + 1
+    in_brick = occupied & (offset // plates_to_brick <
+                           length // plates_to_brick)
+    bottoms = in_brick & (offset % plates_to_brick == 0)
+    cleared = in_brick & ~bottoms
+
+    bricks[bottoms] = GridObject.BRICK_TYPES.index(GridObject.BRICK_LARGE)
+    colors[cleared] = empty_color
+    bricks[cleared] = Grid.EMPTY_BRICK
+    return in_brick, bottoms
+
+
+# footprints tried by `merge_footprints`, largest first, as (cells along x,
+# cells along z, rotated)
+_MERGE_ORDER = ((4, 2, False), (2, 4, True), (2, 2, False),
+                (4, 1, False), (1, 4, True), (2, 1, False), (1, 2, True))
+
+
+def merge_footprints(colors, bricks, stagger=False):
+    """
+    Greedy horizontal merging of `Grid.merge_footprints` on (x, y, z) color
+    and brick arrays, in place. Each footprint is tiled on a lattice of
+    anchors, one lattice offset at a time; tiles of one offset never
+    overlap, so every offset is a single vectorized pass over all layers.
+    Returns the number of parts placed and of cells they cover.
+    """
+    small = GridObject.BRICK_TYPES.index(GridObject.BRICK_SMALL)
+    large = GridObject.BRICK_TYPES.index(GridObject.BRICK_LARGE)
+    # cells still free to merge, keyed by color and 1x1 part; -1 otherwise
+    keys = np.where((bricks == small) | (bricks == large),
+                    colors.astype(np.int32) * 2 + (bricks == large), -1)
+
+    xdim, ydim, zdim = bricks.shape
+    parts = covered = 0
+    if not ydim:
+        # e.g. the odd layers of a single layer
+        return parts, covered
+    for size_x, size_z, rotated in _MERGE_ORDER:
+        footprint = (size_z, size_x) if rotated else (size_x, size_z)
+        merged = np.array([GridObject.BRICK_TYPES.index(
+            GridObject.MERGED_PARTS[base][footprint])
+            for base in (GridObject.BRICK_SMALL, GridObject.BRICK_LARGE)])
+        if rotated:
+            merged |= Grid.ROTATED
 
-def to_blocks(scaling, face, jitter):
-    blocks = [scaling.to_grid_point(fc) for fc in face]
-    bounds = np.min(blocks, axis=0), np.max(blocks, axis=0) + 1
-    grid_dim_real = jitter * (scaling.bounds.range_ / scaling.grid_dimensions)
-    ranges = [range(lo, hi) for lo, hi in zip(*bounds)]
+        for off_x, off_z in it.product(_tile_offsets(size_x, stagger),
+                                       _tile_offsets(size_z, stagger)):
+            tiles_x, tiles_z = (xdim - off_x) // size_x, \
+                (zdim - off_z) // size_z
+            if not tiles_x or not tiles_z:
+                continue
+            box = (slice(off_x, off_x + tiles_x * size_x), slice(None),
+                   slice(off_z, off_z + tiles_z * size_z))
+            shape = (tiles_x, size_x, ydim, tiles_z, size_z)
+            # splitting axes never copies, so these are views
+            tile_keys = keys[box].reshape(shape)
+            tile_bricks = bricks[box].reshape(shape)
+
+            anchors = tile_keys[:, :1, :, :, :1]
+            fits = (anchors >= 0) & \
+                (tile_keys == anchors).all(axis=(1, 4), keepdims=True)
+            count = np.count_nonzero(fits)
+            if not count:
+                continue
+
+            cells = np.broadcast_to(fits, shape)
+            tile_keys[cells] = -1
+            anchor_bricks = tile_bricks[:, :1, :, :, :1]
+            part = merged[(anchor_bricks[fits] == large).astype(int)]
+            tile_bricks[cells] = Grid.COVERED
+            anchor_bricks[fits] = part
+            parts += count
+            covered += count * size_x * size_z
+
+    return parts, covered
+
+
+def merge_layer_footprints(colors, bricks, y_lo, stagger=False):
+    """
+    `merge_footprints` on a box of layers starting at layer `y_lo`, with
+    the layers of odd y staggered when `stagger` is set.
+    """
+    parts = covered = 0
+    for parity in (0, 1):
+        # layers of the box whose absolute y has this parity
+        layers = slice((y_lo + parity) % 2, None, 2)
+        counts = merge_footprints(colors[:, layers], bricks[:, layers],
+                                  stagger and parity == 1)
+        parts, covered = parts + counts[0], covered + counts[1]
+    return parts, covered
+
+
+def _tile_offsets(size, stagger):
+    start = size // 2 if stagger else 0
+    return [(start + i) % size for i in range(size)]
+
+
+def voxelize_faces(scaling, faces, vs, vts, jitter, on_face=None,
+                   voxel_texture=False, weighted=False):
+    """
+    Voxelizes `faces` without touching a grid. Returns an (N, 3) array of
+    cell positions and the (N, 3) RGB color written to each, in write
+    order, and with `weighted` the area of the face of every write. Cells
+    take the average color of their face, or with `voxel_texture` the
+    texel of a textured face under their center.
+    """
+    get_profiler().count('faces', len(faces))
+    positions, colors, areas = [], [], []
+    for face_count, face in enumerate(faces):
+        if on_face is not None:
+            on_face(face_count)
+        vertices = np.array([vs[fc.v] for fc in face])
+        if voxel_texture and face.texture_info:
+            blocks, triangles = to_blocks(scaling, vertices, jitter, True)
+            weights = barycentric_weights(
+                vertices, scaling.to_world_points(blocks + 0.5), triangles)
+            colors.append(sample_face_texture(face, vts, weights))
+        else:
+            blocks = to_blocks(scaling, vertices, jitter)
+            color = np.average(compute_face_colors(face, vts), axis=0)
+            colors.append(np.broadcast_to(color, blocks.shape))
+        positions.append(blocks)
+        if weighted:
+            areas.append(np.full(len(blocks), face_area(vertices)))
+
+    if not positions:
+        positions, colors = [np.empty((0, 3), dtype=int)], [np.empty((0, 3))]
+    result = np.concatenate(positions), np.concatenate(colors).astype(float)
+    if weighted:
+        result += (np.concatenate(areas) if areas else np.empty(0),)
+    return result
+
+
+def face_area(vertices):
+    """ Area of a planar polygon given by its (k, 3) vertices. """
+    return np.linalg.norm(
+        np.cross(vertices, np.roll(vertices, -1, axis=0)).sum(axis=0)) / 2
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _shard(faces, start, stop):
+    # the face index arrays of a FaceList, without its textures
+    if isinstance(faces, FaceList):
+        return (faces.vertices[start:stop], faces.texcoords[start:stop],
+                faces.normals[start:stop], faces.materials[start:stop])
+    return faces[start:stop]
+
+
+def _voxelize_shard(shard):
+    """
+    Voxelizes one shard in a worker process. Returns the `voxelize_faces`
+    result followed by the shard's profiling counters.
+    """
+    scaling, vs, vts, textures, kds, jitter, voxel_texture, blend, \
+        profile = _worker_args
+    profiler = set_profiler(Profiler() if profile else None)
+    faces = FaceList(*shard, textures, kds) if isinstance(shard, tuple) \
+        else shard
+    result = voxelize_faces(scaling, faces, vs, vts, jitter,
+                            voxel_texture=voxel_texture, weighted=blend)
+    return result + (dict(profiler.counters) if profiler.enabled else {},)
+
+
+def to_blocks(scaling, face, jitter, triangles=False):
+    """
+    Cells whose box, scaled by `jitter`, intersects the polygon of `face`
+    vertices, triangle by triangle (i, i + 1, i + 2). Returns an (M, 3) int
+    array, and with `triangles` the index i of the triangle of every cell.
+    """
+    blocks = scaling.to_grid_points(face)
+    bounds = blocks.min(axis=0), blocks.max(axis=0) + 1
+    grid_dim_real = jitter * scaling.cell
+    profiler = get_profiler()
+    rejections = {} if profiler.enabled else None
     vertices = len(face)
+    hit_blocks, hit_triangles = [], []
     for i in range(vertices - 2):
         triangle = np.take(face, [j % vertices for j in range(i, i + 3)], axis=0)
-        for block in (Point.as_int(block) for block in it.product(*ranges)):
-            block_center_real = scaling.to_world_point(block + 0.5)
-            if intersects_box(triangle, block_center_real, grid_dim_real):
-                yield block
+        candidates = plane_slab_blocks(scaling, triangle, bounds,
+                                       grid_dim_real)
+        profiler.count('cells_tested', len(candidates))
+        # bounded batches keep the (M, 3, 3, 3) temporaries of the test small
+        for start in range(0, len(candidates), CANDIDATE_BATCH):
+            batch = candidates[start:start + CANDIDATE_BATCH]
+            centers_real = scaling.to_world_points(batch + 0.5)
+            hits = intersects_boxes(
+                triangle, centers_real, grid_dim_real, rejections)
+            hit_blocks.append(batch[hits])
+            hit_triangles.append(np.full(len(hit_blocks[-1]), i))
+
+    for category, value in (rejections or {}).items():
+        profiler.count('sat_rejected_' + category, value)
+    if not hit_blocks:
+        hit_blocks, hit_triangles = [np.empty((0, 3), dtype=int)], [[]]
+    blocks = np.concatenate(hit_blocks)
+    if triangles:
+        return blocks, np.concatenate(hit_triangles).astype(int)
+    return blocks
+
+
+def barycentric_weights(face, points, triangles):
+    """
+    (M, k) weights of the k `face` vertices at `points` projected on the
+    plane of their triangle (see `to_blocks`), clamped to the triangle so
+    cells whose center falls just outside it take the nearest edge.
+    """
+    a, b, c = (face[triangles + j] for j in range(3))
+    v0, v1, v2 = b - a, c - a, points - a
+    d00 = np.einsum('ij,ij->i', v0, v0)
+    d01 = np.einsum('ij,ij->i', v0, v1)
+    d11 = np.einsum('ij,ij->i', v1, v1)
+    d20 = np.einsum('ij,ij->i', v2, v0)
+    d21 = np.einsum('ij,ij->i', v2, v1)
+    denom = d00 * d11 - d01 * d01
+    # degenerate triangles weigh their vertices equally
+    flat = denom == 0
+    denom[flat] = 1
+    v = np.where(flat, 1 / 3, (d11 * d20 - d01 * d21) / denom)
+    w = np.where(flat, 1 / 3, (d00 * d21 - d01 * d20) / denom)
+    bary = np.clip(np.stack([1 - v - w, v, w], axis=1), 0, None)
+    bary /= bary.sum(axis=1, keepdims=True)
+
+    weights = np.zeros((len(points), len(face)))
+    rows = np.arange(len(points))
+    for j in range(3):
+        weights[rows, triangles + j] = bary[:, j]
+    return weights
+
+
+# candidate cells `to_blocks` tests against a triangle at once
+CANDIDATE_BATCH = 1 << 14
+
+
+def plane_slab_blocks(scaling, triangle, bounds, box_extents):
+    """
+    Candidate cells within `bounds` = (lo, hi) whose box can touch the plane
+    of `triangle`. Scans the columns along the axis the plane is steepest
+    against and keeps only the cells of each column inside the slab
+    |n . (c - v0)| <= r, so a large triangle yields O(n^2) cells rather
+    than its whole O(n^3) bounding box. A triangle without area has no
+    plane and goes to `segment_blocks`. Returns an (M, 3) int array.
+    """
+    lo, hi = (np.asarray(b, dtype=int) for b in bounds)
+    cell = scaling.cell
+    normal = np.cross(triangle[1] - triangle[0], triangle[2] - triangle[1])
+    r = np.sum(np.asarray(box_extents) * np.abs(normal))
+
+    # column axis k, along which the slab spans the fewest cells
+    k = int(np.argmax(np.abs(normal) * cell))
+    if normal[k] == 0:
+        # collinear vertices: the longest edge holds the third one
+        edges = [(i, (i + 1) % 3) for i in range(3)]
+        i, j = max(edges, key=lambda e: np.sum(
+            (triangle[e[1]] - triangle[e[0]]) ** 2))
+        return segment_blocks(scaling, triangle[i], triangle[j], bounds,
+                              box_extents)
+
+    a, b = [i for i in range(3) if i != k]
+    ia, ib = np.meshgrid(np.arange(lo[a], hi[a]), np.arange(lo[b], hi[b]),
+                         indexing='ij')
+    ia, ib = ia.ravel(), ib.ravel()
+    origin = scaling.origin
+    center = lambda i, idx: cell[i] * (idx + 0.5) + origin[i]
+    rest = normal[a] * center(a, ia) + normal[b] * center(b, ib) - \
+        np.dot(normal, triangle[0])
+
+    # solve n_k * c_k + rest in [-r, r] for the cell index along k
+    ends = [((side - rest) / normal[k] - origin[k]) / cell[k] - 0.5
+            for side in (-r, r)]
+    eps = 1e-6
+    k_lo = np.maximum(np.ceil(np.minimum(*ends) - eps), lo[k]).astype(int)
+    k_hi = np.minimum(np.floor(np.maximum(*ends) + eps), hi[k] - 1).astype(int)
+    counts = np.maximum(k_hi - k_lo + 1, 0)
+
+    total = counts.sum()
+    column_start = np.repeat(np.cumsum(counts) - counts, counts)
+    blocks = np.empty((total, 3), dtype=int)
+    blocks[:, a] = np.repeat(ia, counts)
+    blocks[:, b] = np.repeat(ib, counts)
+    blocks[:, k] = np.repeat(k_lo, counts) + np.arange(total) - column_start
+    return blocks
+
+
+def segment_blocks(scaling, p, q, bounds, box_extents):
+    """
+    Candidate cells within `bounds` = (lo, hi) whose box, `box_extents` from
+    its center along each axis, can touch the segment from `p` to `q`.
+    Walks the layers of cells across the axis the segment is steepest
+    along; each layer takes the cells the piece of the segment within its
+    reach can touch, so the candidates grow with the segment's length
+    rather than with its bounding box. Returns an (M, 3) int array.
+    """
+    lo, hi = (np.asarray(b, dtype=int) for b in bounds)
+    cell, origin = scaling.cell, scaling.origin
+    extents = np.asarray(box_extents, dtype=float)
+    direction = q - p
+    k = int(np.argmax(np.abs(direction) / cell))
+    if direction[k] == 0:
+        # a single point, which `bounds` already hugs
+        return np.stack(np.meshgrid(*[np.arange(l, h) for l, h in
+                                      zip(lo, hi)], indexing='ij'),
+                        axis=-1).reshape(-1, 3)
+
+    eps = 1e-6
+    layers = np.arange(lo[k], hi[k])
+    center = cell[k] * (layers + 0.5) + origin[k]
+    # segment parameters where it is within reach of each layer
+    t0 = (center - extents[k] - p[k]) / direction[k]
+    t1 = (center + extents[k] - p[k]) / direction[k]
+    t_lo = np.clip(np.minimum(t0, t1) - eps, 0, 1)
+    t_hi = np.clip(np.maximum(t0, t1) + eps, 0, 1)
+    reached = (np.maximum(t0, t1) >= -eps) & (np.minimum(t0, t1) <= 1 + eps)
+    layers, t_lo, t_hi = layers[reached], t_lo[reached], t_hi[reached]
+
+    # range of cell indices along the other axes each layer can touch
+    a, b = [i for i in range(3) if i != k]
+    ranges = []
+    for i in (a, b):
+        ends = p[i] + direction[i] * np.stack([t_lo, t_hi])
+        low = (ends.min(axis=0) - extents[i] - origin[i]) / cell[i] - 0.5
+        high = (ends.max(axis=0) + extents[i] - origin[i]) / cell[i] - 0.5
+        ranges.append((
+            np.maximum(np.ceil(low - eps), lo[i]).astype(int),
+            np.minimum(np.floor(high + eps), hi[i] - 1).astype(int)))
+    (a_lo, a_hi), (b_lo, b_hi) = ranges
+    count_a = np.maximum(a_hi - a_lo + 1, 0)
+    count_b = np.maximum(b_hi - b_lo + 1, 0)
+    counts = count_a * count_b
+
+    total = counts.sum()
+    local = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    width = np.repeat(count_b, counts)
+    blocks = np.empty((total, 3), dtype=int)
+    blocks[:, k] = np.repeat(layers, counts)
+    blocks[:, a] = np.repeat(a_lo, counts) + local // np.maximum(width, 1)
+    blocks[:, b] = np.repeat(b_lo, counts) + local % np.maximum(width, 1)
+    return blocks
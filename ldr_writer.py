@@ -0,0 +1,76 @@
+from grid import Grid, GridObject
+from colors import rgb2hex
+from profiling import get_profiler
+from reporter import ProgressReporter
+
+
+class LdrWriter:
+    """
+    Buffered writer for `.ldr` files. Bricks are written a layer at a time:
+    all lines of a layer are formatted from the layer's arrays and written
+    as a single chunk, preceded by a `0 STEP` separator.
+    """
+
+    BUFFER_SIZE = 1 << 20
+    MATRIX_STR = '1 0 0 0 1 0 0 0 1'
+
+    def __init__(self, file, palette_rgb):
+        self.file = file
+        self.step = 0
+        self.bytes_written = 0
+        self.color_codes = ['0x2{}'.format(rgb2hex(v)) for v in palette_rgb]
+        # per brick value, rotated ones included: the part, the line suffix
+        # and the offset from a part's cell to its center
+        self.bricks = {}
+        for index, brick in enumerate(GridObject.BRICK_TYPES):
+            for value, rotated in ((index, False),
+                                   (index | Grid.ROTATED, True)):
+                self.bricks[value] = GridObject('', brick, rotated)
+        self.brick_suffixes = {
+            value: ' {} {}'.format(
+                GridObject.ROTATED_MATRIX_STR if part.rotated
+                else LdrWriter.MATRIX_STR, part.brick_type)
+            for value, part in self.bricks.items()}
+        self.brick_offsets = {
+            value: ((part.footprint[0] - 1)*Grid.UNIT_WIDTH//2,
+                    (part.footprint[1] - 1)*Grid.UNIT_DEPTH//2)
+            for value, part in self.bricks.items()}
+
+    def write_layer(self, y, xs, zs, colors, bricks):
+        if not len(xs):
+            return
+
+        chunk = []
+        if y != self.step:
+            chunk.append('0 STEP\n')
+            self.step = y
+
+        # cells covered by a part placed in another cell write nothing
+        placed = bricks != Grid.COVERED
+        xs, zs, colors, bricks = \
+            xs[placed], zs[placed], colors[placed], bricks[placed]
+
+        ys = {value: str(-(y*Grid.UNIT_HEIGHT +
+                           GridObject.BRICK_HEIGHTS[part.brick_type]))
+              for value, part in self.bricks.items()}
+        codes, suffixes = self.color_codes, self.brick_suffixes
+        offsets = self.brick_offsets
+        chunk.extend(
+            '1 {} {} {} {}{}\n'.format(
+                codes[c], x*Grid.UNIT_WIDTH + offsets[b][0], ys[b],
+                z*Grid.UNIT_DEPTH + offsets[b][1], suffixes[b])
+            for x, z, c, b in zip(xs.tolist(), zs.tolist(),
+                                  colors.tolist(), bricks.tolist()))
+
+        text = ''.join(chunk)
+        self.file.write(text)
+        self.bytes_written += len(text)
+
+    def write_grid(self, grid, progress=None):
+        progress = progress or ProgressReporter()
+        progress.start('write', grid.shape[1])
+        for layer in grid.get_cells_by_layer():
+            self.write_layer(*layer)
+            progress.update(layer[0])
+        progress.finish()
+        get_profiler().count('bytes_written', self.bytes_written)
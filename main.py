@@ -1,52 +1,21 @@
-
 import os
-import numpy as np
 
 from config import *
-from obj_parser import load_obj_file
-from grid import Scaling, Grid
-from colors import hex2rgb, rgb2hex
+from pipeline import load_voxels, load_palette, convert
+from streaming import stream_convert
+from profiling import Profiler, set_profiler
+from reporter import SINKS, create_reporter
+from fill import parse_fill
 from argparse import ArgumentParser
 
 
-def increment_on_write_step(file, y, step):
-    if y != step:
-        print('0 STEP', file=file)
-    return y
-
-
-def output_ldr(filename, grid, palette_rgb):
-    transform_matrix_str = ' '.join(str(i) for i in np.ravel(
-        [[1, 0, 0],
-         [0, 1, 0],
-         [0, 0, 1]]))
-
-    colors_hex_0x2 = ['0x2{}'.format(rgb2hex(v)) for v in palette_rgb]
-    as_hex_0x2 = lambda rgb: colors_hex_0x2[palette_rgb.index(rgb)]
-
-    # debug method for me. can be deleted
-    # as_colors_id = lambda rgb: colors_id[palette_rgb.index(rgb)]
-
-    with open(filename, 'w') as f:
-        step = 0
-
-        for x, y, z in grid.get_bricks_by_layer():
-            pt = (x, y, z)
-
-            step = increment_on_write_step(f, y, step)
-            line = grid[pt].to_ldr_repr(
-                transform_matrix_str, pt, as_hex_0x2)
-
-            print(line, file=f)
-
-
 def output_header_details():
     print('{:#^40}'.format(' Blockify '))
     print()
     print('Input file: {}'.format(args.input))
-    print('Output file: {}'.format(args.out))
-    print('Height: {}'.format(args.total_height))
-    print('Colors: {}'.format(str(color_library.color_sets[args.color_set])))
+    print('Output file: {}'.format(', '.join(out_files.values())))
+    print('Height: {}'.format(', '.join(map(str, heights))))
+    print('Colors: {}'.format(str(get_library().color_sets[args.color_set])))
     if args.bricks_only:
         print('Computing for bricks only (no plates)')
     else:
@@ -56,7 +25,6 @@ def output_header_details():
 
 
 if __name__ == "__main__":
-    color_library = ColorLibrary()
     parser = ArgumentParser()
     parser.add_argument(
         'input', type=str, help='.obj input file path')
@@ -65,10 +33,64 @@ if __name__ == "__main__":
     parser.add_argument(
         '-o', '--out', type=str, help='.ldr file name', default=None)
     parser.add_argument(
-        '-t', '--total-height', type=int, help='Total height of the lego model',
-        default=80)
+        '-t', '--total-height', type=int, nargs='+', default=[80],
+        help='Total height of the lego model. With several heights, the '
+             'model is voxelized once at the highest and downsampled to the '
+             'others, and one .ldr is written per height')
     parser.add_argument(
         '-b', '--bricks-only', action='store_true', help='Use bricks instead of plates')
+    parser.add_argument(
+        '-w', '--workers', type=int, help='Number of voxelization processes',
+        default=1)
+    parser.add_argument(
+        '--color-bins', type=int, default=None,
+        help='Quantize colors through a lookup table with this many bins per '
+             'RGB channel instead of an exact palette search')
+    parser.add_argument(
+        '--cache-dir', type=str, default=None,
+        help='Directory to cache parsed meshes in between runs')
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Store the grid in chunks allocated on first write, for very '
+             'large heights. Does not go with --fill, which needs the '
+             'whole volume in memory')
+    parser.add_argument(
+        '--fill', type=parse_fill, default=None, metavar='solid|shell:N',
+        help='Fill closed interiors, or fill them and hollow the result '
+             'down to walls N voxels thick')
+    parser.add_argument(
+        '--voxel-texture', action='store_true',
+        help='Color each voxel with the texel under it instead of the '
+             'average texture color of its face')
+    parser.add_argument(
+        '--blend', action='store_true',
+        help='Color voxels touched by several faces with the mean of their '
+             'colors weighted by face area, instead of the last face\'s')
+    parser.add_argument(
+        '--state', type=str, default=None, metavar='FILE',
+        help='Save the voxelized model to FILE, or reuse it from there when '
+             'only palette or brick options changed since')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='Parse, voxelize and write at the same time, writing layers as '
+             'soon as they are complete')
+    parser.add_argument(
+        '--merge', action='store_true',
+        help='Merge same-colored plates and bricks of a layer into larger '
+             '1x2, 1x4, 2x2 and 2x4 parts')
+    parser.add_argument(
+        '--stagger', action='store_true',
+        help='With --merge, offset the seams of alternate layers')
+    parser.add_argument(
+        '--profile', type=str, default=None, metavar='REPORT',
+        help='Write per-stage time and counters to a JSON file')
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help='With --profile, also trace the peak memory of every stage in '
+             'the main process; this slows the run down')
+    parser.add_argument(
+        '--progress', choices=sorted(SINKS), default='bar',
+        help='Progress output on stderr: a terminal bar, JSON lines or none')
     args = parser.parse_args()
 
     if args.bricks_only:
@@ -77,17 +99,47 @@ if __name__ == "__main__":
 
     if args.out is None:
         args.out = os.path.splitext(os.path.basename(args.input))[0] + '.ldr'
+    heights = sorted(set(args.total_height), reverse=True)
+    out_files = {heights[0]: args.out} if len(heights) == 1 else \
+        {height: '{}_{}{}'.format(os.path.splitext(args.out)[0], height,
+                                  os.path.splitext(args.out)[1])
+         for height in heights}
+
+    if args.sparse and args.fill is not None:
+        parser.error('--fill works on the whole volume at once, which '
+                     '--sparse is meant to avoid; use one or the other')
+    if args.stream and (len(heights) > 1 or args.fill is not None or
+                        args.state or args.cache_dir or args.blend):
+        parser.error('--stream reads the .obj file once for one height; it '
+                     'does not go with several heights, --fill, --state, '
+                     '--cache-dir or --blend')
+
+    profiler = set_profiler(
+        Profiler(args.profile_memory) if args.profile else None)
+    progress = create_reporter(args.progress)
 
     output_header_details()
-    obj_file = load_obj_file(args.input)
-
-    scaling = Scaling(obj_file.vs.bounds, plate_height_ratio, args.total_height)
-
-    palette_rgb = [hex2rgb(c) for c in colors_hex]
-    grid = Grid.create(scaling, obj_file, palette_rgb, brick_expand_jitter) \
-        .normalize(plates_to_brick)
-
-    out_file = args.out or \
-        os.path.splitext(os.path.basename(args.input))[0] + '.ldr'
-
-    output_ldr(out_file, grid, palette_rgb)
+    with profiler.stage('palette'):
+        palette_rgb, quantizer = load_palette(args.color_set, args.color_bins)
+
+    if args.stream:
+        stream_convert(args.input, heights[0], args.out, palette_rgb,
+                       quantizer, plates_to_brick, plate_height_ratio,
+                       brick_expand_jitter, args.workers, args.merge,
+                       args.stagger, args.sparse, progress=progress,
+                       voxel_texture=args.voxel_texture)
+    else:
+        voxels, reused = load_voxels(
+            args.input, heights[0], plate_height_ratio, args.workers,
+            args.cache_dir, args.state, progress, args.voxel_texture,
+            args.blend)
+        if reused:
+            print('Reusing voxels from {}'.format(args.state))
+
+        for height, out_file in out_files.items():
+            convert(voxels, height, out_file, palette_rgb, quantizer,
+                    plates_to_brick, plate_height_ratio, args.fill,
+                    args.merge, args.stagger, args.sparse, progress)
+
+    if args.profile:
+        profiler.write_report(args.profile)
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from obj_parser import ObjMesh, Material, load_obj_mesh
+
+
+# Bump when the ObjMesh layout or the parser output changes
+CACHE_VERSION = 1
+
+ARRAY_FIELDS = ('vertices', 'texcoords', 'normals', 'face_vertices',
+                'face_texcoords', 'face_normals', 'face_materials')
+
+
+def load_obj_mesh_cached(obj_location, cache_dir):
+    """
+    `load_obj_mesh` backed by an on-disk cache in `cache_dir`. Entries are
+    keyed by the absolute path, size, mtime and content hash of the `.obj`
+    file, and are dropped when any `.mtl` or texture file they were built
+    from has changed since. Arrays of a cached mesh are memory-mapped.
+    """
+    entry_dir = os.path.join(cache_dir, cache_key(obj_location))
+    mesh = read_entry(entry_dir)
+    if mesh is None:
+        mesh = load_obj_mesh(obj_location)
+        write_entry(entry_dir, mesh)
+    return mesh
+
+
+def cache_key(obj_location):
+    stat = os.stat(obj_location)
+    key = hashlib.blake2b(digest_size=16)
+    key.update(json.dumps([CACHE_VERSION, os.path.abspath(obj_location),
+                           stat.st_size, stat.st_mtime_ns]).encode())
+    with open(obj_location, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+    return key.hexdigest()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def mesh_dependencies(mesh):
+    """ Files besides the `.obj` that `mesh` was built from. """
+    return list(mesh.material_libraries) + \
+        [m.texture_file for m in mesh.materials if m.texture_file]
+
+
+def read_entry(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, 'mesh.json')) as f:
+            meta = json.load(f)
+        for path, signature in meta['dependencies'].items():
+            if file_signature(path) != signature:
+                return None
+        arrays = {field: np.load(os.path.join(entry_dir, field + '.npy'),
+                                 mmap_mode='r')
+                  for field in ARRAY_FIELDS}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    materials = [Material(m['name'],
+                          None if m['Kd'] is None else np.array(m['Kd']),
+                          m['texture_file'])
+                 for m in meta['materials']]
+    return ObjMesh(materials=materials,
+                   material_libraries=meta['material_libraries'], **arrays)
+
+
+def write_entry(entry_dir, mesh):
+    dependencies = mesh_dependencies(mesh)
+    meta = {
+        'materials': [{'name': m.name,
+                       'Kd': None if m.Kd is None else list(m.Kd),
+                       'texture_file': m.texture_file}
+                      for m in mesh.materials],
+        'material_libraries': list(mesh.material_libraries),
+        'dependencies': {path: file_signature(path) for path in dependencies},
+    }
+
+    # build the entry next to its final location and move it in place, so
+    # concurrent runs never see a partial entry
+    cache_dir = os.path.dirname(entry_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        for field in ARRAY_FIELDS:
+            np.save(os.path.join(tmp_dir, field + '.npy'),
+                    getattr(mesh, field))
+        with open(os.path.join(tmp_dir, 'mesh.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -3,12 +3,29 @@ import glob
 import numpy as np
 
 from collections import namedtuple, defaultdict
-from PIL import Image
-from util import Point, Bounds
+from util import Bounds
 
 
+# `data` is an (h, w, 3) uint8 array of RGB texels
 TextureInfo = namedtuple("TextureInfo", ['data', 'w', 'h'])
 VertexInfo = namedtuple("VertexInfo", ['values', 'bounds'])
+Material = namedtuple("Material", ['name', 'Kd', 'texture_file'])
+
+# Array form of a `.obj` file. `face_vertices`, `face_texcoords` and
+# `face_normals` are (F, k) int32 arrays of 0-based indices padded with
+# `FACE_PAD` for faces with fewer than k components (missing texture or
+# normal indices are -1, as in `handle_face`); `face_materials` indexes
+# `materials`, -1 for faces without a material. `material_libraries` lists
+# the `.mtl` files read.
+ObjMesh = namedtuple("ObjMesh", [
+    'vertices', 'texcoords', 'normals',
+    'face_vertices', 'face_texcoords', 'face_normals',
+    'face_materials', 'materials', 'material_libraries'])
+FACE_PAD = np.iinfo(np.int32).min
+# vertex lines `load_obj_file` reads between two conversions to arrays
+BOUNDS_CHUNK = 65536
+# components kept of each kind of vertex, as in `ObjMesh`
+VERTEX_WIDTHS = {'v': 3, 'vt': 2, 'vn': 3}
 
 
 class ParsedObjFile:
@@ -22,6 +39,58 @@ class ParsedObjFile:
         self.vts = VertexInfo(vertices['vt'], bounds['vt'])
         self.vns = VertexInfo(vertices['vn'], bounds['vn'])
 
+    @classmethod
+    def from_mesh(cls, mesh):
+        """
+        Thin view over an `ObjMesh`: vertex values are the mesh arrays and
+        `faces` builds Face objects on access.
+        """
+        textures = [None if m.texture_file is None
+                    else load_texture(m.texture_file) for m in mesh.materials]
+        kds = [m.Kd for m in mesh.materials]
+        faces = FaceList(mesh.face_vertices, mesh.face_texcoords,
+                         mesh.face_normals, mesh.face_materials, textures, kds)
+        vertices = {'v': mesh.vertices, 'vt': mesh.texcoords,
+                    'vn': mesh.normals}
+        bounds = {k: Bounds.from_array(v) for k, v in vertices.items()}
+        return cls(faces, bounds, vertices)
+
+
+class FaceList:
+    """
+    Sequence of Face objects backed by the face index arrays of an
+    `ObjMesh`. Slicing returns a FaceList over the sliced arrays.
+    """
+
+    def __init__(self, vertices, texcoords, normals, materials, textures, kds):
+        self.vertices = vertices
+        self.texcoords = texcoords
+        self.normals = normals
+        self.materials = materials
+        self.textures = textures
+        self.kds = kds
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return FaceList(self.vertices[i], self.texcoords[i],
+                            self.normals[i], self.materials[i],
+                            self.textures, self.kds)
+
+        size = np.count_nonzero(self.vertices[i] != FACE_PAD)
+        elements = np.stack([self.vertices[i], self.texcoords[i],
+                             self.normals[i]], axis=1)[:size]
+        material = self.materials[i]
+        if material < 0:
+            return Face([FaceComponent(e) for e in elements], None)
+        return Face([FaceComponent(e) for e in elements],
+                    self.textures[material], self.kds[material])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
 
 class Face:
     """
@@ -73,7 +142,10 @@ def load_obj_file(obj_location):
         bounds = defaultdict(Bounds)
         textures = defaultdict(None)
         texture_to_rgb = defaultdict(None)
-        vertices = defaultdict(list)
+        # array chunks of every kind of vertex, and the rows of the chunk
+        # being read
+        chunks = defaultdict(list)
+        pending = defaultdict(list)
 
         file_dir = os.path.dirname(obj_location)
         mtl_state = None
@@ -89,18 +161,176 @@ def load_obj_file(obj_location):
             elif key == 'usemtl':
                 mtl_state = components[1]
             elif key.startswith('v'):
-                value = Point(components[1:])
-                vertices[key].append(value)
-                bounds[key].update(value)
+                pending[key].append(components[1:])
+                if len(pending[key]) == BOUNDS_CHUNK:
+                    chunks[key].append(_vertex_chunk(key, pending.pop(key)))
             elif key == 'f':
                 texture = textures.get(mtl_state, None)
                 face = handle_face(components[1:], texture)
                 face.Kd = texture_to_rgb.get(mtl_state, None)
                 faces.append(face)
 
+    for key, rows in pending.items():
+        chunks[key].append(_vertex_chunk(key, rows))
+    vertices = defaultdict(list)
+    for key, values in chunks.items():
+        for chunk in values:
+            bounds[key].merge(Bounds.from_array(chunk))
+        vertices[key] = np.concatenate(values)
     return ParsedObjFile(faces, bounds, vertices)
 
 
+def load_obj_mesh(obj_location):
+    """
+    Loads a `.obj` file into contiguous arrays (see `ObjMesh`) without
+    creating per-vertex or per-face objects. Textures are not opened; the
+    material table only records their resolved file names.
+    """
+    faces = []
+    face_materials = []
+
+    def on_face(items, material, rows):
+        faces.append(items)
+        face_materials.append(material)
+
+    mesh = _read_obj(obj_location, on_face)
+    face_vertices, face_texcoords, face_normals = _face_arrays(faces)
+    return mesh._replace(
+        face_vertices=face_vertices, face_texcoords=face_texcoords,
+        face_normals=face_normals,
+        face_materials=np.array(face_materials, dtype=np.int32))
+
+
+def scan_obj_mesh(obj_location, batch_size):
+    """
+    First pass of a streamed load: the ObjMesh of a `.obj` file without its
+    faces, and for every `batch_size` faces in file order the lowest
+    vertex y they use (-inf when a face uses a vertex defined after it).
+    `iter_obj_faces` then reads the faces themselves.
+    """
+    lows = []
+    count = [0]
+
+    def on_face(items, material, rows):
+        vertex_rows = rows['v']
+        try:
+            low = min(float(vertex_rows[int(item.split('/', 1)[0]) - 1][1])
+                      for item in items)
+        except IndexError:
+            low = -np.inf
+        if count[0] % batch_size == 0:
+            lows.append(low)
+        else:
+            lows[-1] = min(lows[-1], low)
+        count[0] += 1
+
+    return _read_obj(obj_location, on_face), np.array(lows, dtype=float)
+
+
+def iter_obj_faces(obj_location, batch_size):
+    """
+    Second pass of a streamed load: yields the faces of a `.obj` file as
+    (face_vertices, face_texcoords, face_normals, face_materials) arrays
+    (see `ObjMesh`) of `batch_size` faces, in file order.
+    """
+    faces, face_materials = [], []
+    material_index = {}
+    mtl_state = -1
+    with open(obj_location) as f:
+        for components in (x.split() for x in f):
+            if not components:
+                continue
+            key = components[0]
+            if key == 'f':
+                faces.append(components[1:])
+                face_materials.append(mtl_state)
+                if len(faces) == batch_size:
+                    yield _face_arrays(faces) + \
+                        (np.array(face_materials, dtype=np.int32),)
+                    faces, face_materials = [], []
+            elif key == 'usemtl':
+                mtl_state = material_index.setdefault(
+                    components[1], len(material_index))
+    if faces:
+        yield _face_arrays(faces) + \
+            (np.array(face_materials, dtype=np.int32),)
+
+
+def _read_obj(obj_location, on_face):
+    # reads everything but the faces, which go to
+    # on_face(items, material index, vertex rows read so far)
+    rows = defaultdict(list)
+    material_index = {}
+    material_libraries = []
+    texture_to_file, texture_to_rgb = {}, {}
+    file_dir = os.path.dirname(obj_location)
+    mtl_state = -1
+
+    with open(obj_location) as f:
+        for components in (x.split() for x in f):
+            if not components:
+                continue
+            key = components[0]
+
+            if key == 'f':
+                on_face(components[1:], mtl_state, rows)
+            elif key.startswith('v'):
+                rows[key].append(components[1:])
+            elif key == 'usemtl':
+                mtl_state = material_index.setdefault(
+                    components[1], len(material_index))
+            elif key == 'mtllib':
+                mtl_file_location = os.path.join(file_dir, components[1])
+                material_libraries.append(mtl_file_location)
+                texture_to_file, texture_to_rgb = find_texture_info(
+                        mtl_file_location)
+
+    materials = [Material(name, texture_to_rgb.get(name, None),
+                          find_texture_file(file_dir, texture_to_file[name])
+                          if name in texture_to_file else None)
+                 for name in material_index]
+    face_vertices, face_texcoords, face_normals = _face_arrays([])
+
+    return ObjMesh(
+        _vertex_array(rows['v'], 3), _vertex_array(rows['vt'], 2),
+        _vertex_array(rows['vn'], 3),
+        face_vertices, face_texcoords, face_normals,
+        np.empty(0, dtype=np.int32), materials, material_libraries)
+
+
+def _vertex_array(rows, width, dtype=np.float64):
+    values = np.zeros((len(rows), width), dtype=dtype)
+    if not rows:
+        return values
+    if all(len(row) == len(rows[0]) for row in rows):
+        values[:, :min(width, len(rows[0]))] = \
+            np.array(rows, dtype=dtype)[:, :width]
+        return values
+    for i, row in enumerate(rows):
+        row = row[:width]
+        values[i, :len(row)] = np.array(row, dtype=dtype)
+    return values
+
+
+def _face_arrays(faces):
+    # values are 1-indexed in .obj files
+    k = max((len(face) for face in faces), default=3)
+    indices = np.full((len(faces), k, 3), FACE_PAD, dtype=np.int32)
+    for i, face in enumerate(faces):
+        for j, item in enumerate(face):
+            values = item.split('/')
+            indices[i, j] = -1
+            indices[i, j, :len(values)] = \
+                [(int(val) - 1) if val else -1 for val in values[:3]]
+    return indices[..., 0], indices[..., 1], indices[..., 2]
+
+
+def _vertex_chunk(key, rows):
+    # kinds without a fixed width keep the components all their rows have
+    width = VERTEX_WIDTHS.get(key) or min(len(row) for row in rows)
+    return _vertex_array(rows, width)
+
+
 def handle_face(face_items, mtl):
     # values are 1-indexed in .obj files
     index_or_none = lambda val: (int(val) - 1) if val else -1
@@ -126,13 +356,16 @@ def find_texture_info(mtl_file_location):
     return texture_to_filename_dict, texture_to_rgb_dict
 
 
-def load_textures(base_dir, texture_to_filename_dict):
-    def open_img_recursive_in_subdirs(filename):
-        files = glob.glob(base_dir + '/**/' + filename, recursive=True)
-        return Image.open(files[0])
+def find_texture_file(base_dir, filename):
+    return glob.glob(base_dir + '/**/' + filename, recursive=True)[0]
+
 
-    def transform(img):
-        return TextureInfo(list(img.getdata()), *img.size)
+def load_texture(texture_file):
+    from PIL import Image
+    img = Image.open(texture_file)
+    return TextureInfo(np.asarray(img.convert('RGB')), *img.size)
 
-    return {k: transform(open_img_recursive_in_subdirs(v))
+
+def load_textures(base_dir, texture_to_filename_dict):
+    return {k: load_texture(find_texture_file(base_dir, v))
             for k, v in texture_to_filename_dict.items()}
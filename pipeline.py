@@ -0,0 +1,104 @@
+import os
+
+from config import get_library, brick_expand_jitter, unit_distance
+from obj_parser import load_obj_mesh, ParsedObjFile
+from mesh_cache import load_obj_mesh_cached, mesh_dependencies, \
+    file_signature
+from grid import Scaling, Grid
+from voxel_state import VoxelState
+from ldr_writer import LdrWriter
+from colors import hex2rgb, PaletteQuantizer
+from profiling import get_profiler
+from reporter import ProgressReporter
+
+
+def output_ldr(filename, grid, palette_rgb, progress=None):
+    with open(filename, 'w', buffering=LdrWriter.BUFFER_SIZE) as f:
+        LdrWriter(f, palette_rgb).write_grid(grid, progress)
+
+
+def load_palette(color_set='all', bins=None):
+    """
+    RGB palette of a color set of colors.yaml, with its quantizer: an exact
+    palette search, or a lookup table with `bins` bins per channel.
+    """
+    palette_rgb = [hex2rgb(c) for c in get_library().set_to_hex(color_set)]
+    quantizer = PaletteQuantizer(palette_rgb, exact=True) if bins is None \
+        else PaletteQuantizer(palette_rgb, bins=bins)
+    return palette_rgb, quantizer
+
+
+def load_voxels(obj_location, height, plate_height_ratio, workers=1,
+                cache_dir=None, state=None, progress=None,
+                voxel_texture=False, blend=False):
+    """
+    Voxelizes an `.obj` file at `height`, sampling textures per voxel with
+    `voxel_texture` and blending the colors of all faces of a voxel with
+    `blend` (see `Grid.voxelize`). With `state`, the voxels are read from
+    that file when they were saved for the same input and geometry
+    options, and saved there otherwise. Returns the VoxelState and
+    whether it was reused.
+    """
+    profiler = get_profiler()
+    progress = progress or ProgressReporter()
+    # everything voxelization depends on; palette and brick options are not
+    state_key = [os.path.abspath(obj_location), file_signature(obj_location),
+                 height, plate_height_ratio, unit_distance,
+                 brick_expand_jitter, voxel_texture, blend]
+    voxels = None if state is None else VoxelState.load(state, state_key)
+    if voxels is not None:
+        return voxels, True
+
+    with profiler.stage('parse'):
+        progress.start('parse')
+        mesh = load_obj_mesh(obj_location) if cache_dir is None \
+            else load_obj_mesh_cached(obj_location, cache_dir)
+        obj_file = ParsedObjFile.from_mesh(mesh)
+        progress.finish()
+
+    scaling = Scaling(obj_file.vs.bounds, plate_height_ratio, height)
+    with profiler.stage('voxelize'):
+        voxels = Grid.voxelize(scaling, obj_file, brick_expand_jitter,
+                               workers, progress, voxel_texture, blend)
+    voxels.dependencies = mesh_dependencies(mesh)
+    if state is not None:
+        voxels.save(state, state_key, voxels.dependencies)
+    return voxels, False
+
+
+def convert(voxels, height, out_file, palette_rgb, quantizer,
+            plates_to_brick, plate_height_ratio, fill=None, merge=False,
+            stagger=False, sparse=False, progress=None):
+    """
+    Builds the grid of `voxels` at `height`, downsampling them when they
+    were made for a greater height, and writes it to `out_file`. `fill`
+    is None, or the `fill.Fill` to apply. Returns the grid.
+    """
+    profiler = get_profiler()
+    progress = progress or ProgressReporter()
+    shape = tuple(int(d) for d in Scaling(
+        voxels.bounds, plate_height_ratio, height).grid_dimensions)
+    if shape != voxels.shape:
+        with profiler.stage('downsample'):
+            voxels = voxels.downsample(shape)
+
+    with profiler.stage('quantize'):
+        grid = Grid.from_voxels(voxels, palette_rgb, quantizer, sparse)
+    if fill is not None:
+        with profiler.stage('fill'):
+            progress.start('fill')
+            grid.fill(fill.thickness)
+            progress.finish()
+    with profiler.stage('normalize'):
+        progress.start('normalize')
+        grid.normalize(plates_to_brick)
+        progress.finish()
+    if merge:
+        with profiler.stage('merge'):
+            progress.start('merge')
+            grid.merge_footprints(stagger)
+            progress.finish()
+
+    with profiler.stage('write'):
+        output_ldr(out_file, grid, palette_rgb, progress)
+    return grid
@@ -0,0 +1,120 @@
+import json
+import os
+import time
+import tracemalloc
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+class Profiler:
+    """
+    Records wall time and CPU time for each pipeline stage, plus named
+    counters that the pipeline increments as it goes. `cpu_time` is the
+    main process's; `worker_cpu_time` is that of the worker processes
+    that exited during the stage, such as a voxelization pool.
+
+    With `memory`, the peak memory of each stage is traced with
+    tracemalloc, relative to the memory already allocated when the stage
+    starts. It only covers the main process, and tracing slows every
+    allocation down, so times are then inflated.
+    """
+
+    enabled = True
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = []
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+        workers = _children_cpu_time()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            stage = {
+                'name': name,
+                'wall_time': time.perf_counter() - wall,
+                'cpu_time': time.process_time() - cpu,
+                'worker_cpu_time': _children_cpu_time() - workers,
+            }
+            if self.memory:
+                stage['peak_memory'] = \
+                    tracemalloc.get_traced_memory()[1] - memory
+            self.stages.append(stage)
+
+    def count(self, name, value=1):
+        self.counters[name] += int(value)
+
+    def merge(self, counters):
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def report(self):
+        return {'stages': self.stages, 'counters': dict(self.counters),
+                'memory_traced': self.memory}
+
+    def write_report(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def _stop_tracing():
+    # forked workers inherit tracing, which would only slow them down
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_stop_tracing)
+
+
+def _children_cpu_time():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class NullProfiler:
+    """
+    Profiler that records nothing. Code paths that need extra work to
+    produce a counter should check `enabled` first.
+    """
+
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield self
+
+    def count(self, name, value=1):
+        pass
+
+    def merge(self, counters):
+        pass
+
+
+_profiler = NullProfiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = NullProfiler() if profiler is None else profiler
+    return _profiler
@@ -0,0 +1,105 @@
+import json
+import sys
+import time
+
+
+class ProgressReporter:
+    """
+    Reports the progress of pipeline stages to a sink at a bounded rate:
+    `update` forwards at most one value per `interval` seconds. Without a
+    sink `update` is a single comparison, so hot loops can call it freely.
+
+    A sink implements start(stage, total), update(stage, value, total) and
+    finish(stage, total).
+    """
+
+    def __init__(self, sink=None, interval=0.25):
+        self.sink = sink
+        self.interval = interval
+        self.stage = None
+        self.total = None
+        self._next_value = float('inf')
+        self._next_time = 0
+
+    @property
+    def enabled(self):
+        return self.sink is not None
+
+    def start(self, stage, total=None):
+        self.stage, self.total = stage, total
+        if self.sink is not None:
+            self.sink.start(stage, total)
+            self._next_value = 0
+            self._next_time = time.monotonic() + self.interval
+
+    def update(self, value):
+        if value < self._next_value:
+            return
+        now = time.monotonic()
+        if now < self._next_time:
+            return
+        self._next_time = now + self.interval
+        self.sink.update(self.stage, value, self.total)
+
+    def finish(self):
+        if self.sink is not None:
+            self.sink.finish(self.stage, self.total)
+        self._next_value = float('inf')
+        self.stage, self.total = None, None
+
+
+class TerminalSink:
+    """ Progress bar on stderr; only stages with a known total get a bar. """
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.bar = None
+
+    def start(self, stage, total):
+        if total:
+            import progressbar
+            self.bar = progressbar.ProgressBar(
+                max_value=total, fd=self.stream,
+                prefix='{}: '.format(stage)).start()
+
+    def update(self, stage, value, total):
+        if self.bar is not None:
+            self.bar.update(min(value, total))
+
+    def finish(self, stage, total):
+        if self.bar is not None:
+            self.bar.finish()
+            self.bar = None
+
+
+class JsonLinesSink:
+    """ One JSON object per event, e.g. for headless batch workers. """
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+
+    def _emit(self, event, stage, value, total):
+        self.stream.write(json.dumps({
+            'event': event, 'stage': stage, 'value': value, 'total': total,
+            'time': time.time()}) + '\n')
+        self.stream.flush()
+
+    def start(self, stage, total):
+        self._emit('start', stage, 0, total)
+
+    def update(self, stage, value, total):
+        self._emit('update', stage, value, total)
+
+    def finish(self, stage, total):
+        self._emit('finish', stage, total, total)
+
+
+SINKS = {
+    'bar': TerminalSink,
+    'json': JsonLinesSink,
+    'none': lambda: None,
+}
+
+
+def create_reporter(kind='none'):
+    return ProgressReporter(SINKS[kind]())
@@ -0,0 +1,216 @@
+import itertools as it
+import numpy as np
+
+
+class DenseStorage:
+    """
+    Voxel storage backed by one dense array covering the whole grid.
+
+    Storages are indexed like arrays with a tuple of three ints or of three
+    int arrays (one cell or many), and expose `read_box` / `write_box` for
+    whole-box operations and `column_boxes` to walk the grid in boxes that
+    span its full height.
+    """
+
+    COLUMN = 64
+
+    def __init__(self, shape, dtype, fill):
+        self.shape = tuple(int(d) for d in shape)
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        self.array = np.full(self.shape, fill, dtype=dtype)
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __setitem__(self, key, value):
+        self.array[key] = value
+
+    def read_box(self, lo, hi):
+        """ Cells in [lo, hi); the result may be a view into the storage. """
+        return self.array[tuple(slice(l, h) for l, h in zip(lo, hi))]
+
+    def write_box(self, lo, block):
+        box = tuple(slice(l, l + d) for l, d in zip(lo, block.shape))
+        self.array[box] = block
+
+    def column_boxes(self):
+        """
+        Boxes of at most COLUMN x COLUMN cells across, spanning the full
+        height, so whole-column work on them stays bounded in memory.
+        """
+        xdim, ydim, zdim = self.shape
+        for x, z in it.product(range(0, xdim, self.COLUMN),
+                               range(0, zdim, self.COLUMN)):
+            yield (x, 0, z), (min(x + self.COLUMN, xdim), ydim,
+                              min(z + self.COLUMN, zdim))
+
+    def cells(self, y_lo, y_hi):
+        """
+        Positions (xs, ys, zs) and values of all cells holding something
+        other than `fill` with y_lo <= y < y_hi, in no particular order.
+        """
+        rows = self.array[:, y_lo:y_hi]
+        xs, ys, zs = np.nonzero(rows != self.fill)
+        return xs, ys + y_lo, zs, rows[xs, ys, zs]
+
+    def count(self, ignore=()):
+        """ Number of cells holding neither `fill` nor one of `ignore`. """
+        return int(np.count_nonzero(
+            ~np.isin(self.array, (self.fill,) + tuple(ignore))))
+
+    def release_below(self, y):
+        """
+        Frees what memory it can of the layers below `y`, which must not be
+        read again. A dense array cannot shrink, so this does nothing.
+        """
+
+
+class ChunkedStorage:
+    """
+    Sparse voxel storage made of CHUNK^3 bricks that are allocated on first
+    write. Memory grows with the number of chunks touched, i.e. with the
+    surface of a voxelized model rather than with its bounding volume.
+    Same interface as DenseStorage.
+    """
+
+    CHUNK = 16
+
+    def __init__(self, shape, dtype, fill):
+        self.shape = tuple(int(d) for d in shape)
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        self.chunks = {}
+        # (x, z) keys of the allocated chunks of every chunk row y
+        self.rows = {}
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def _chunk(self, key, allocate):
+        chunk = self.chunks.get(key)
+        if chunk is None and allocate:
+            chunk = np.full((self.CHUNK,) * 3, self.fill, dtype=self.dtype)
+            self.chunks[key] = chunk
+            self.rows.setdefault(key[1], set()).add((key[0], key[2]))
+        return chunk
+
+    def _split(self, key):
+        """
+        Groups the cells of an index tuple by chunk. Yields every chunk key
+        with the flat indices of its cells and their indices within it.
+        """
+        cells = np.stack(np.broadcast_arrays(*key), axis=-1).reshape(-1, 3)
+        chunk_keys, inverse = np.unique(
+            cells // self.CHUNK, axis=0, return_inverse=True)
+        # cells sorted by chunk, so each chunk's cells are one slice
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        ends = np.cumsum(np.bincount(inverse.reshape(-1),
+                                     minlength=len(chunk_keys)))
+        local = cells % self.CHUNK
+        for chunk_key, start, end in zip(chunk_keys.tolist(),
+                                         ends - np.diff(ends, prepend=0),
+                                         ends):
+            indices = order[start:end]
+            yield tuple(chunk_key), indices, tuple(local[indices].T)
+
+    def __getitem__(self, key):
+        if all(np.ndim(k) == 0 for k in key):
+            chunk = self.chunks.get(tuple(int(k) // self.CHUNK for k in key))
+            if chunk is None:
+                return self.dtype.type(self.fill)
+            return chunk[tuple(int(k) % self.CHUNK for k in key)]
+
+        shape = np.broadcast(*key).shape
+        values = np.full(int(np.prod(shape)), self.fill, dtype=self.dtype)
+        for chunk_key, indices, local in self._split(key):
+            chunk = self.chunks.get(chunk_key)
+            if chunk is not None:
+                values[indices] = chunk[local]
+        return values.reshape(shape)
+
+    def __setitem__(self, key, value):
+        if all(np.ndim(k) == 0 for k in key):
+            chunk = self._chunk(
+                tuple(int(k) // self.CHUNK for k in key), allocate=True)
+            chunk[tuple(int(k) % self.CHUNK for k in key)] = value
+            return
+
+        value = np.broadcast_to(value, np.broadcast(*key).shape).reshape(-1)
+        for chunk_key, indices, local in self._split(key):
+            self._chunk(chunk_key, allocate=True)[local] = value[indices]
+
+    def _chunk_overlaps(self, lo, hi):
+        """
+        Yields (chunk key, slices into the chunk, slices into the box) for
+        every chunk position overlapping the box [lo, hi).
+        """
+        ranges = [range(l // self.CHUNK, -(-h // self.CHUNK))
+                  for l, h in zip(lo, hi)]
+        for key in it.product(*ranges):
+            start = [max(l, k * self.CHUNK) for l, k in zip(lo, key)]
+            stop = [min(h, (k + 1) * self.CHUNK) for h, k in zip(hi, key)]
+            yield key, \
+                tuple(slice(s - k * self.CHUNK, e - k * self.CHUNK)
+                      for s, e, k in zip(start, stop, key)), \
+                tuple(slice(s - l, e - l) for s, e, l in zip(start, stop, lo))
+
+    def read_box(self, lo, hi):
+        block = np.full([h - l for l, h in zip(lo, hi)], self.fill,
+                        dtype=self.dtype)
+        for key, in_chunk, in_block in self._chunk_overlaps(lo, hi):
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                block[in_block] = chunk[in_chunk]
+        return block
+
+    def write_box(self, lo, block):
+        hi = [l + d for l, d in zip(lo, block.shape)]
+        for key, in_chunk, in_block in self._chunk_overlaps(lo, hi):
+            values = block[in_block]
+            chunk = self._chunk(key, allocate=np.any(values != self.fill))
+            if chunk is not None:
+                chunk[in_chunk] = values
+
+    def cells(self, y_lo, y_hi):
+        keys = sorted((x, y, z)
+                      for y in range(y_lo // self.CHUNK,
+                                     -(-y_hi // self.CHUNK))
+                      for x, z in self.rows.get(y, ()))
+        parts = []
+        for x, y, z in keys:
+            lo = max(y_lo - y * self.CHUNK, 0)
+            hi = min(y_hi - y * self.CHUNK, self.CHUNK)
+            rows = self.chunks[x, y, z][:, lo:hi]
+            xs, ys, zs = np.nonzero(rows != self.fill)
+            parts.append((xs + x * self.CHUNK, ys + lo + y * self.CHUNK,
+                          zs + z * self.CHUNK, rows[xs, ys, zs]))
+        if not parts:
+            empty = np.empty(0, dtype=int)
+            return empty, empty, empty, np.empty(0, dtype=self.dtype)
+        return tuple(np.concatenate(part) for part in zip(*parts))
+
+    def count(self, ignore=()):
+        values = (self.fill,) + tuple(ignore)
+        return sum(int(np.count_nonzero(~np.isin(chunk, values)))
+                   for chunk in self.chunks.values())
+
+    def release_below(self, y):
+        """ Drops the chunks lying entirely below layer `y`. """
+        for chunk_y in [chunk_y for chunk_y in self.rows
+                        if (chunk_y + 1) * self.CHUNK <= y]:
+            for x, z in self.rows.pop(chunk_y):
+                del self.chunks[x, chunk_y, z]
+
+    def column_boxes(self):
+        columns = sorted({(x, z) for x, _, z in self.chunks})
+        for x, z in columns:
+            lo = (x * self.CHUNK, 0, z * self.CHUNK)
+            hi = (min(lo[0] + self.CHUNK, self.shape[0]), self.shape[1],
+                  min(lo[2] + self.CHUNK, self.shape[2]))
+            yield lo, hi
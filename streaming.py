@@ -0,0 +1,250 @@
+import queue
+import threading
+import numpy as np
+
+from collections import deque
+from obj_parser import ParsedObjFile, FaceList, scan_obj_mesh, iter_obj_faces
+from grid import Scaling, Grid, GridObject, voxelize_faces, merge_plates, \
+    merge_layer_footprints
+from ldr_writer import LdrWriter
+from profiling import Profiler, get_profiler, set_profiler
+from reporter import ProgressReporter
+
+
+# faces per batch sent from the parser to the voxelizer
+BATCH_SIZE = 256
+# batches, or windows of layers, held between two stages
+QUEUE_SIZE = 8
+
+
+def stream_convert(obj_location, height, out_file, palette_rgb, quantizer,
+                   plates_to_brick, plate_height_ratio, jitter, workers=1,
+                   merge=False, stagger=False, sparse=False,
+                   batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE,
+                   progress=None, voxel_texture=False):
+    """
+    Converts an `.obj` file with parsing, voxelization and writing running
+    at the same time. A first pass reads the vertices and materials, and
+    the lowest layer each batch of faces can reach. Then a parser thread
+    feeds face batches through a bounded queue to the voxelizer (`workers`
+    processes), whose results are written to the grid in file order. As
+    soon as no batch left can reach a layer, the layer is normalized and
+    sent through another bounded queue to a writer thread. The output is
+    the same as converting the whole file stage by stage.
+    """
+    profiler = get_profiler()
+    progress = progress or ProgressReporter()
+    with profiler.stage('scan'):
+        mesh, batch_lows = scan_obj_mesh(obj_location, batch_size)
+        obj_file = ParsedObjFile.from_mesh(mesh)
+    scaling = Scaling(obj_file.vs.bounds, plate_height_ratio, height)
+    grid = Grid(scaling.grid_dimensions, palette_rgb, sparse)
+    ydim = grid.shape[1]
+
+    # layers below final[b] are complete once the batches before b are in
+    # (the y of `Scaling.to_grid_point`)
+    lows = np.clip(np.round((batch_lows - obj_file.vs.bounds.lo.y) *
+                            scaling.scale.y), 0, ydim - 1)
+    final = np.append(np.minimum.accumulate(lows[::-1])[::-1], ydim)
+
+    faces_q = queue.Queue(queue_size)
+    threading.Thread(target=_parse, daemon=True,
+                     args=(obj_location, batch_size, faces_q)).start()
+
+    with profiler.stage('stream'), \
+            open(out_file, 'w', buffering=LdrWriter.BUFFER_SIZE) as f:
+        layers_q = queue.Queue(queue_size)
+        writer = _LayerWriter(LdrWriter(f, palette_rgb), grid.shape,
+                              plates_to_brick, grid.empty_color, merge,
+                              stagger)
+        writer_thread = threading.Thread(
+            target=writer.run, args=(layers_q,), daemon=True)
+        writer_thread.start()
+
+        small = GridObject.BRICK_TYPES.index(GridObject.BRICK_SMALL)
+        lookahead = plates_to_brick - 1
+        emitted = 0
+        progress.start('stream', len(batch_lows))
+        batches = _voxelized(faces_q, scaling, obj_file, jitter, workers,
+                             queue_size, voxel_texture)
+        for b, (positions, rgb) in enumerate(batches):
+            profiler.count('voxels_written', len(positions))
+            grid.write_cells(positions, quantizer.quantize(rgb), small)
+            progress.update(b + 1)
+
+            # layers are sent once the layers a brick on them could reach
+            # are complete too
+            top = ydim if final[b + 1] >= ydim else \
+                int(final[b + 1]) - lookahead
+            if top > emitted:
+                emitted = _emit(grid, layers_q, emitted, top, lookahead)
+        if emitted < ydim:
+            _emit(grid, layers_q, emitted, ydim, lookahead)
+        progress.finish()
+
+        layers_q.put(None)
+        writer_thread.join()
+        if writer.error is not None:
+            raise writer.error
+    profiler.count('bytes_written', writer.writer.bytes_written)
+    return grid
+
+
+def _emit(grid, layers_q, y_lo, y_hi, lookahead):
+    """
+    Sends layers [y_lo, y_hi) to the writer, along with up to `lookahead`
+    layers above them, and frees them in the grid. Returns `y_hi`.
+    """
+    xdim, ydim, zdim = grid.shape
+    lo, hi = (0, y_lo, 0), (xdim, min(y_hi + lookahead, ydim), zdim)
+    # copies: the writer works on them in place while the grid fills up
+    layers_q.put((y_lo, np.array(grid.colors.read_box(lo, hi)),
+                  np.array(grid.bricks.read_box(lo, hi)), y_hi - y_lo))
+    grid.colors.release_below(y_hi)
+    grid.bricks.release_below(y_hi)
+    return y_hi
+
+
+def _parse(obj_location, batch_size, faces_q):
+    try:
+        for arrays in iter_obj_faces(obj_location, batch_size):
+            faces_q.put(arrays)
+    except Exception as e:
+        faces_q.put(e)
+        return
+    faces_q.put(None)
+
+
+def _face_batches(faces_q):
+    while True:
+        arrays = faces_q.get()
+        if arrays is None:
+            return
+        if isinstance(arrays, Exception):
+            raise arrays
+        yield arrays
+
+
+def _voxelized(faces_q, scaling, obj_file, jitter, workers, queue_size,
+               voxel_texture):
+    """
+    Yields the `voxelize_faces` result of every batch of `faces_q`, in
+    order, with at most `queue_size` batches in flight in the workers.
+    """
+    textures, kds = obj_file.faces.textures, obj_file.faces.kds
+    vs, vts = obj_file.vs.values, obj_file.vts.values
+    if workers <= 1:
+        for arrays in _face_batches(faces_q):
+            yield voxelize_faces(scaling, FaceList(*arrays, textures, kds),
+                                 vs, vts, jitter,
+                                 voxel_texture=voxel_texture)
+        return
+
+    import multiprocessing
+    profiler = get_profiler()
+    args = (scaling, vs, vts, textures, kds, jitter, voxel_texture,
+            profiler.enabled)
+    with multiprocessing.Pool(workers, _init_worker, args) as pool:
+        pending = deque()
+        for arrays in _face_batches(faces_q):
+            pending.append(pool.apply_async(_voxelize_batch, (arrays,)))
+            if len(pending) >= queue_size:
+                *result, counters = pending.popleft().get()
+                profiler.merge(counters)
+                yield tuple(result)
+        while pending:
+            *result, counters = pending.popleft().get()
+            profiler.merge(counters)
+            yield tuple(result)
+
+
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _voxelize_batch(arrays):
+    """
+    Voxelizes one batch of face arrays in a worker process. Returns the
+    `voxelize_faces` result followed by the batch's profiling counters.
+    """
+    scaling, vs, vts, textures, kds, jitter, voxel_texture, profile = \
+        _worker_args
+    profiler = set_profiler(Profiler() if profile else None)
+    faces = FaceList(*arrays, textures, kds)
+    result = voxelize_faces(scaling, faces, vs, vts, jitter,
+                            voxel_texture=voxel_texture)
+    return result + (dict(profiler.counters) if profiler.enabled else {},)
+
+
+class _LayerWriter:
+    """
+    Writer thread side of `stream_convert`: normalizes every window of
+    layers it gets, carrying the vertical runs that continue from one
+    window into the next, and writes the layers out.
+    """
+
+    def __init__(self, writer, shape, plates_to_brick, empty_color, merge,
+                 stagger):
+        self.writer = writer
+        self.plates_to_brick = plates_to_brick
+        self.empty_color = empty_color
+        self.merge = merge
+        self.stagger = stagger
+        # colors of the last layer written and the length of the vertical
+        # run each of its cells ends, before normalizing
+        xdim, _, zdim = shape
+        self.below = (np.full((xdim, zdim), empty_color),
+                      np.zeros((xdim, zdim), dtype=int))
+        self.error = None
+
+    def run(self, layers_q):
+        while True:
+            window = layers_q.get()
+            if window is None:
+                return
+            if self.error is None:
+                try:
+                    self.write(*window)
+                except Exception as e:
+                    # keep draining so the voxelizer never blocks
+                    self.error = e
+
+    def write(self, y_lo, colors, bricks, count):
+        profiler = get_profiler()
+        below = self.below
+        self.below = self._run_lengths(colors[:, :count],
+                                       bricks[:, :count], below)
+        in_brick, bottoms = merge_plates(
+            colors, bricks, self.plates_to_brick, self.empty_color, below)
+        colors, bricks = colors[:, :count], bricks[:, :count]
+        if profiler.enabled:
+            profiler.count('voxels_merged',
+                           np.count_nonzero(in_brick[:, :count]))
+            profiler.count('bricks_merged',
+                           np.count_nonzero(bottoms[:, :count]))
+        if self.merge:
+            parts, covered = merge_layer_footprints(
+                colors, bricks, y_lo, self.stagger)
+            profiler.count('parts_merged', parts)
+            profiler.count('cells_covered', covered)
+
+        for row in range(count):
+            layer = bricks[:, row]
+            # cells ordered by z and then x, as in Grid.get_cells_by_layer
+            zs, xs = np.nonzero(layer.T != Grid.EMPTY_BRICK)
+            self.writer.write_layer(y_lo + row, xs, zs, colors[xs, row, zs],
+                                    layer[xs, zs])
+
+    def _run_lengths(self, colors, bricks, below):
+        colors_below, lengths = below
+        for row in range(colors.shape[1]):
+            occupied = bricks[:, row] != Grid.EMPTY_BRICK
+            continues = occupied & (lengths > 0) & \
+                (colors[:, row] == colors_below)
+            lengths = np.where(continues, lengths + 1, occupied.astype(int))
+            colors_below = colors[:, row]
+        return colors_below.copy(), lengths
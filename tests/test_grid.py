@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from grid import Grid, GridObject
+from intersect import intersects_box, intersects_boxes
+
+
+PALETTE = [(0, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255)]
+
+
+def normalize_bottom_up(colors, bricks, plates_to_brick, empty_color):
+    """
+    The original per-cell `Grid.normalize`: visits the cells layer by layer
+    from the bottom and turns the `plates_to_brick` plates ending at each
+    into one brick when they are all present and of one color.
+    """
+    colors, bricks = colors.copy(), bricks.copy()
+    large = GridObject.BRICK_TYPES.index(GridObject.BRICK_LARGE)
+    for y in range(plates_to_brick - 1, bricks.shape[1]):
+        for x, z in zip(*np.nonzero(bricks[:, y] != Grid.EMPTY_BRICK)):
+            run = [(x, y - i, z) for i in range(plates_to_brick)]
+            bottom = run[-1]
+            if all(bricks[cell] != Grid.EMPTY_BRICK for cell in run) and \
+                    all(colors[cell] == colors[bottom] for cell in run):
+                for cell in run[:-1]:
+                    colors[cell] = empty_color
+                    bricks[cell] = Grid.EMPTY_BRICK
+                bricks[bottom] = large
+    return colors, bricks
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('plates_to_brick', [1, 2, 3])
+def test_normalize_matches_bottom_up(sparse, plates_to_brick):
+    rng = np.random.default_rng(plates_to_brick)
+    small = GridObject.BRICK_TYPES.index(GridObject.BRICK_SMALL)
+    for _ in range(5):
+        # few colors and dense columns, so that runs of every length occur
+        shape = tuple(rng.integers(1, 40, 3))
+        occupied = rng.random(shape) < 0.7
+        positions = tuple(np.nonzero(occupied))
+        grid = Grid(shape, PALETTE, sparse)
+        grid.set_cell(positions, rng.integers(0, 2, len(positions[0])),
+                      small)
+
+        lo = (0, 0, 0)
+        colors, bricks = normalize_bottom_up(
+            grid.colors.read_box(lo, shape), grid.bricks.read_box(lo, shape),
+            plates_to_brick, grid.empty_color)
+        grid.normalize(plates_to_brick)
+
+        assert np.array_equal(grid.colors.read_box(lo, shape), colors)
+        assert np.array_equal(grid.bricks.read_box(lo, shape), bricks)
+
+
+def test_intersects_boxes_matches_intersects_box():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        triangle = rng.normal(size=(3, 3))
+        centers = rng.uniform(-2, 2, size=(200, 3))
+        extents = rng.uniform(0.05, 0.5, size=3)
+
+        expected = [bool(intersects_box(triangle, center, extents))
+                    for center in centers]
+        assert intersects_boxes(triangle, centers, extents).tolist() == \
+            expected
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_cells_read_back_through_indexing(sparse):
+    red, blue = (255, 0, 0), (0, 0, 255)
+    grid = Grid((2, 2, 4), [red, blue], sparse)
+    grid[(0, 1, 0)] = GridObject(red, GridObject.BRICK_SMALL)
+    grid[(1, 1, 0)] = GridObject(blue, '3001.dat', rotated=True)
+    for x in range(2):
+        for z in range(4):
+            grid[(x, 0, z)] = GridObject(blue, GridObject.BRICK_SMALL)
+    grid.merge_footprints()
+
+    cells = [grid[pos] for pos in ((0, 1, 0), (1, 1, 0), (0, 0, 0))]
+    assert [(tuple(cell.color), cell.brick_type, cell.rotated)
+            for cell in cells] == [(red, GridObject.BRICK_SMALL, False),
+                                   (blue, '3001.dat', True),
+                                   (blue, '3020.dat', True)]
+    # the rest of the merged 2x4 plate is covered
+    assert grid[(1, 0, 3)] is None
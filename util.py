@@ -35,7 +35,9 @@ class Point(np.ndarray):
 class Bounds:
     """
     A class for keeping track of bounds. Works with Point instances,
-    and automatically updates n-dimensional lo/hi values.
+    and automatically updates n-dimensional lo/hi values. Bounds of whole
+    arrays come from `from_array`, and partial bounds (e.g. of the chunks
+    of a parse) are combined with `merge`.
     """
 
     INITIAL_POINT = Point(None)
@@ -62,6 +64,33 @@ class Bounds:
 
         return self
 
+    @classmethod
+    def from_array(cls, values, dtype=float):
+        """ Bounds of the rows of an (n, d) array. """
+        bounds = cls(dtype=dtype)
+        values = np.asarray(values)
+        if len(values):
+            bounds.lo = Point(values.min(axis=0), dtype)
+            bounds.hi = Point(values.max(axis=0), dtype)
+        return bounds
+
+    def merge(self, other):
+        """
+        Extends these bounds to cover those of `other`. As with `update`,
+        bounds of different dimensions are cut to the common ones.
+        """
+        if other.lo is Bounds.INITIAL_POINT:
+            return self
+        if self.lo is Bounds.INITIAL_POINT:
+            self.lo = Point(other.lo, self.dtype)
+            self.hi = Point(other.hi, self.dtype)
+            return self
+
+        n = min(len(self.lo), len(other.lo))
+        self.lo = Point(np.minimum(self.lo[:n], other.lo[:n]), self.dtype)
+        self.hi = Point(np.maximum(self.hi[:n], other.hi[:n]), self.dtype)
+        return self
+
     @property
     def range_(self):
         return self.hi - self.lo
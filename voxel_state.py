@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import numpy as np
+
+from mesh_cache import file_signature
+from util import Bounds
+
+
+# Bump when the saved layout or the voxelizer output changes
+STATE_VERSION = 2
+
+
+class VoxelState:
+    """
+    Result of voxelization before any palette or brick setting applies: the
+    grid shape, the (N, 3) positions of the occupied cells, the (N, 3)
+    unquantized RGB color of each and the model bounds the grid spans.
+    `dependencies` lists the files besides the `.obj` they were made from.
+    `Grid.from_voxels` builds a grid for any palette from it, so a saved
+    state lets later runs skip parsing and voxelization while only palette
+    or brick options change.
+    """
+
+    def __init__(self, shape, positions, rgb, bounds, dependencies=()):
+        self.shape = tuple(int(d) for d in shape)
+        self.positions = positions
+        self.rgb = rgb
+        self.bounds = bounds
+        self.dependencies = list(dependencies)
+
+    def downsample(self, shape):
+        """
+        The state at the lower resolution `shape`, for the same bounds. Each
+        cell goes to the coarse cell holding its center: a coarse cell is
+        occupied when any of its cells is, and takes their mean color. Grid
+        dimensions of the same bounds only differ by a scale factor, which
+        carries the plate height ratio, so indices are enough to map cells.
+        """
+        shape = tuple(int(d) for d in shape)
+        cells = ((self.positions + 0.5) *
+                 (np.array(shape) / np.array(self.shape))).astype(int)
+        cells = np.minimum(cells, np.array(shape) - 1)
+        flat = np.ravel_multi_index(tuple(cells.T), shape)
+        occupied, inverse, counts = np.unique(
+            flat, return_inverse=True, return_counts=True)
+        rgb = np.stack([np.bincount(inverse.reshape(-1), self.rgb[:, c],
+                                    minlength=len(occupied))
+                        for c in range(3)], axis=1) / counts[:, None]
+        positions = np.stack(np.unravel_index(occupied, shape), axis=1)
+        return VoxelState(shape, positions, rgb, self.bounds,
+                          self.dependencies)
+
+    def save(self, filename, key, dependencies=()):
+        """
+        Saves the state with the `key` describing the input and geometry
+        options it was made with, and the size and mtime of the files in
+        `dependencies`.
+        """
+        meta = {
+            'version': STATE_VERSION,
+            'key': key,
+            'dependencies': {path: file_signature(path)
+                             for path in dependencies},
+        }
+        # write next to the final file and move it in place, so concurrent
+        # runs never read a partial state
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, meta=np.array(json.dumps(meta)),
+                         shape=np.array(self.shape),
+                         positions=self.positions.astype(np.int32),
+                         rgb=self.rgb, bounds=np.array(
+                             [self.bounds.lo, self.bounds.hi]))
+            os.replace(tmp_name, filename)
+        except OSError:
+            os.unlink(tmp_name)
+            raise
+
+    @staticmethod
+    def load(filename, key):
+        """
+        The state saved in `filename`, or None when there is none, it was
+        saved with another `key` or one of its dependencies changed.
+        """
+        try:
+            with np.load(filename) as data:
+                meta = json.loads(str(data['meta']))
+                if meta['version'] != STATE_VERSION or \
+                        meta['key'] != json.loads(json.dumps(key)):
+                    return None
+                for path, signature in meta['dependencies'].items():
+                    if file_signature(path) != signature:
+                        return None
+                return VoxelState(data['shape'],
+                                  data['positions'].astype(int), data['rgb'],
+                                  Bounds.from_array(data['bounds']),
+                                  meta['dependencies'])
+        except (OSError, ValueError, KeyError):
+            return None